@@ -0,0 +1 @@
+""" stand-in for Aimsun's PyANGBasic, which aimsun_to_tmdd_json.py imports but does not use. see PyANGKernel.py. """
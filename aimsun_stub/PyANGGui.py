@@ -0,0 +1,27 @@
+"""
+stand-in for Aimsun's PyANGGui. the active gui holds the model of PyANGKernel.synthetic_model, so
+aimsun_to_tmdd_json.main can run unchanged. see PyANGKernel.py.
+"""
+
+import PyANGKernel
+
+
+class GKGUISystem(object):
+    gui = None
+
+    @classmethod
+    def getGUISystem(cls):
+        return cls()
+
+    def getActiveGui(self):
+        if GKGUISystem.gui is None:
+            GKGUISystem.gui = _Gui(PyANGKernel.synthetic_model())
+        return GKGUISystem.gui
+
+
+class _Gui(object):
+    def __init__(self, model):
+        self.model = model
+
+    def getActiveModel(self):
+        return self.model
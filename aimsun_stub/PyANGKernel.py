@@ -0,0 +1,195 @@
+"""
+stand-in for the parts of Aimsun's PyANGKernel that aimsun_to_tmdd_json.py uses, so the export can be run and
+timed outside Aimsun, under python 2 or 3. see extract_offline.py.
+
+synthetic_model builds a grid of junctions joined by sections in both directions, plus the cases the
+exporter filters or patches: sections without an origin or destination junction, a circular section,
+a light rail track and a zero-length section. positions are in metres, and GKCoordinateTranslator maps
+them to degrees around the I-210 corridor, counting its calls.
+"""
+
+import itertools
+import random
+
+__all__ = ['GKType', 'GKCoordinateTranslator', 'GKNode', 'GKSection', 'GKSubPath', 'GKModel', 'synthetic_model']
+
+METRES_PER_DEGREE = 111320.0
+ORIGIN = (-118.12, 34.14)
+# the degrees GKCoordinateTranslator maps position (0, 0) to
+
+
+class GKType(object):
+    eSearchOnlyThisType = 0
+
+
+class GKCoordinateTranslator(object):
+    calls = 0
+    # toDegrees calls made by every translator, so tests can check positions are translated once
+
+    def __init__(self, model):
+        self.model = model
+
+    def toDegrees(self, point):
+        GKCoordinateTranslator.calls += 1
+        return _Point(ORIGIN[0] + point[0] / (METRES_PER_DEGREE * 0.83), ORIGIN[1] + point[1] / METRES_PER_DEGREE)
+
+
+class _Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class _Object(object):
+    def __init__(self, object_id, name):
+        self.object_id = object_id
+        self.name = name
+
+    def getId(self):
+        return self.object_id
+
+    def getName(self):
+        return self.name
+
+
+class GKNode(_Object):
+    def __init__(self, object_id, name, position):
+        _Object.__init__(self, object_id, name)
+        self.position = position
+
+    def getPosition(self):
+        return self.position
+
+
+class _RoadType(_Object):
+    pass
+
+
+class _Lane(object):
+    def isFullLane(self):
+        return True
+
+
+class GKSection(_Object):
+    def __init__(self, object_id, name, origin, destination, polyline, road_type='street', lanes=2, speed=64.0):
+        _Object.__init__(self, object_id, name)
+        self.origin = origin
+        self.destination = destination
+        self.polyline = polyline
+        self.road_type = _RoadType(0, road_type)
+        self.lanes = [_Lane() for _ in range(lanes)]
+        self.speed = speed
+
+    def getOrigin(self):
+        return self.origin
+
+    def getDestination(self):
+        return self.destination
+
+    def calculatePolyline(self):
+        return list(self.polyline)
+
+    def getRoadType(self):
+        return self.road_type
+
+    def getCapacity(self):
+        return 900.0 * len(self.lanes)
+
+    def getLanes(self):
+        return self.lanes
+
+    def getLaneLength(self, index):
+        return sum(((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2) ** 0.5 for a, b in zip(self.polyline, self.polyline[1:]))
+
+    def getSpeed(self):
+        return self.speed
+
+    def getNbFullLanes(self):
+        return len(self.lanes)
+
+
+class GKSubPath(_Object):
+    def __init__(self, object_id, name, route):
+        _Object.__init__(self, object_id, name)
+        self.route = route
+
+    def getRoute(self):
+        return self.route
+
+    def length3D(self):
+        return sum(section.getLaneLength(0) for section in self.route)
+
+
+class _Objects(dict):
+    """ the objects of one type by id, with python 2's itervalues under python 3 too. """
+    def itervalues(self):
+        return iter(self.values())
+
+
+class _Catalog(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def getUsedSubTypesFromType(self, type_name):
+        return [_Objects((o.getId(), o) for o in self.objects.get(type_name, []))]
+
+
+class GKModel(object):
+    def __init__(self, objects):
+        """
+        :param objects: maps each type name, e.g. 'GKSection', to a list of its objects
+        """
+        self.catalog = _Catalog(objects)
+
+    def getCatalog(self):
+        return self.catalog
+
+    def getType(self, type_name):
+        return type_name
+
+
+def synthetic_model(columns=20, rows=10, block=200.0, vertices=8, seed=0):
+    """
+    :param columns, rows: the junctions along each side of the grid
+    :param block: metres between neighbouring junctions
+    :param vertices: polyline points of each section, between its junctions
+    :return: a GKModel of about 4 * columns * rows sections
+    """
+    r = random.Random(seed)
+    ids = itertools.count(1000)
+    nodes = {}
+    for i in range(columns):
+        for j in range(rows):
+            nodes[i, j] = GKNode(next(ids), 'junction {0} {1}'.format(i, j), (i * block, j * block))
+
+    def polyline(a, b):
+        return [(a[0] + (b[0] - a[0]) * k / (vertices + 1.0) + r.uniform(-1, 1),
+                 a[1] + (b[1] - a[1]) * k / (vertices + 1.0) + r.uniform(-1, 1)) for k in range(1, vertices + 1)]
+
+    sections = []
+    eastbound = []
+    westbound = []
+    for (i, j), node in sorted(nodes.items()):
+        for di, dj in ((1, 0), (0, 1)):
+            other = nodes.get((i + di, j + dj))
+            if other is None:
+                continue
+            for origin, destination in ((node, other), (other, node)):
+                section = GKSection(next(ids), 'section {0}'.format(len(sections)), origin, destination,
+                                    polyline(origin.getPosition(), destination.getPosition()))
+                sections.append(section)
+                if dj == 0 and j == 0:
+                    (eastbound if origin is node else westbound).append(section)
+
+    """ sections the exporter gives dummy nodes, or drops. """
+    corner = nodes[0, 0].getPosition()
+    sections.append(GKSection(next(ids), 'entry', None, nodes[0, 0], polyline((corner[0] - block, corner[1]), corner)))
+    sections.append(GKSection(next(ids), 'exit', nodes[0, 0], None, polyline(corner, (corner[0], corner[1] - block))))
+    sections.append(GKSection(next(ids), 'loop', nodes[0, 0], nodes[0, 0], polyline(corner, (corner[0], corner[1] + 50))))
+    sections.append(GKSection(next(ids), 'rail', nodes[0, 0], nodes[1, 0], polyline(corner, corner), 'light rail track'))
+    sections.append(GKSection(next(ids), 'stub', nodes[0, 0], nodes[0, 1], [], 'street'))
+
+    subpaths = [GKSubPath(next(ids), 'EB_corridor', eastbound),
+                GKSubPath(next(ids), 'WB_corridor', westbound[::-1]),
+                GKSubPath(next(ids), 'local detour', eastbound[:2])]
+    return GKModel({'GKNode': list(nodes.values()), 'GKSection': sections, 'GKSubPath': subpaths})
@@ -0,0 +1,58 @@
+"""
+runs aimsun_to_tmdd_json.py outside Aimsun, against the stand-in PyANG* modules of this directory and a
+synthetic model, and prints how long the export took and how many positions were translated.
+
+run from the repository directory, under python 2 or 3:
+    python aimsun_stub/extract_offline.py -columns 20 -rows 10 -output data
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+STUB_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(STUB_DIRECTORY))
+sys.path.insert(0, STUB_DIRECTORY)
+
+import PyANGKernel
+import aimsun_to_tmdd_json as exporter
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports a synthetic network with the stand-in PyANG* modules.')
+    parser.add_argument('-columns', type=int, default=20, help='junctions along the grid, west to east')
+    parser.add_argument('-rows', type=int, default=10, help='junctions along the grid, south to north')
+    parser.add_argument('-vertices', type=int, default=8, help='polyline points of each section')
+    parser.add_argument('-output', default='data', help='the directory the .json is written to')
+    parser.add_argument('-name', default='tmdd_offline', help='the .json file name, without the extension')
+    parser.add_argument('-check', action='store_true',
+                        help='also check the streamed .json parses to the same document as build_tmdd_map')
+    args = parser.parse_args()
+
+    """ the exporter joins paths with the separator of SYSTEM_TYPE, which is windows inside Aimsun. """
+    exporter.SYSTEM_TYPE = 'windows' if os.sep == '\\' else 'unix'
+    model = PyANGKernel.synthetic_model(args.columns, args.rows, vertices=args.vertices)
+
+    start = time.time()
+    exporter.build_json(model, args.output, args.name, 'PATH Connected Corridors', 'offline', 'synthetic network')
+    print('Exported in {0:.2f}s with {1} toDegrees calls'.format(time.time() - start,
+                                                                 PyANGKernel.GKCoordinateTranslator.calls))
+
+    if args.check:
+        with open(os.path.join(args.output, args.name + '.json')) as f:
+            streamed = json.load(f)
+        """ every element carries the export's own last-update-time, so compare with that, and dummy nodes are
+        numbered on from the previous export, so start again from 0. """
+        exporter.DUMMY_ID = 0
+        update_time = streamed['LinkInventory']['organization-information']['last-update-time']
+        expected = json.loads(json.dumps(exporter.build_tmdd_map(model, 'PATH Connected Corridors', 'offline',
+                                                                 'synthetic network', update_time=update_time)))
+        print('Streamed output matches build_tmdd_map:', streamed == expected)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,22 @@
+from __future__ import print_function
+
 from PyANGBasic import *
 from PyANGKernel import *
 from PyANGGui import *
 from PyANGAimsun import *
 from functools import reduce
 
+import codecs
 import datetime
+import gzip
 import json
 import os
 
+try:
+    import incremental
+except ImportError:
+    incremental = None  # incremental.py must be on Aimsun's python path for INCREMENTAL exports
+
 WINDOWS_ENCODING = '\\'
 UNIX_ENCODING = '/'
 
@@ -18,7 +27,32 @@ MPH_CONSTANT = 0.62137119 # multiply km/hr to convert to mph
 DUMMY_ID = 0
 DIGIT_PRECISION = 7
 
-translator = GKCoordinateTranslator(model)    
+INCREMENTAL = False
+# if true, also writes a delta .json of the elements that changed since the previous export
+
+COMPACT = False
+# if true, the .json is written without indentation
+GZIP = False
+# if true, the .json is written gzip compressed, as .json.gz
+BATCH_SIZE = 5000
+# list elements encoded and written together, with a progress line after each batch
+
+SECTIONS = ('LinkInventory', 'LinkStatus', 'NodeInventory', 'NodeStatus', 'RouteInventory')
+LIST_KEYS = ('link-inventory-list', 'link-status-list', 'node-inventory-list', 'node-status-list',
+             'route-inventory-list')
+
+LAYOUTS = {
+    False: {'options': {'indent': 2, 'separators': (',', ': ')},
+            'open': '{\n', 'close': '\n  }\n}', 'section': '  {0}: {{\n', 'next_section': '\n  },\n',
+            'field': '    {0}: ', 'next_field': ',\n', 'first_record': '\n      ', 'next_record': ',\n      ',
+            'close_list': '\n    ]', 'field_indent': '    ', 'record_indent': '      '},
+    True: {'options': {'separators': (',', ':')},
+           'open': '{', 'close': '}}', 'section': '{0}:{{', 'next_section': '},',
+           'field': '{0}:', 'next_field': ',', 'first_record': '', 'next_record': ',',
+           'close_list': ']', 'field_indent': '', 'record_indent': ''},
+}
+# the text between the encoded values of the document, indented as json.dumps(indent=2) or compact.
+# local_io.py writes the same layout, but requires python 3
 
 
 def build_geolocation(translator, coordinate_pair):
@@ -29,8 +63,25 @@ def build_geolocation(translator, coordinate_pair):
     coordinate = translator.toDegrees(coordinate_pair)
     return {'longitude': coordinate.x, 'latitude': coordinate.y}
 
-def build_organization_information(organization_id):
-    return {'organization-id': organization_id, 'last-update-time': build_update_time()}
+class GeolocationCache:
+    """
+    Translates the position of each object once, however many sections share it.
+    """
+    def __init__(self, translator):
+        self.translator = translator
+        self.locations = dict()
+
+    def position(self, aimsun_object):
+        key = aimsun_object.getId()
+        if key not in self.locations:
+            self.locations[key] = build_geolocation(self.translator, aimsun_object.getPosition())
+        return self.locations[key]
+
+    def point(self, coordinate_pair):
+        return build_geolocation(self.translator, coordinate_pair)
+
+def build_organization_information(organization_id, update_time):
+    return {'organization-id': organization_id, 'last-update-time': update_time}
 
 def build_update_time():
     return {'date': datetime.date.today().strftime("%Y%m%d"), \
@@ -66,15 +117,86 @@ def build_link_restrictions(section_object):
     return {'link-speed-limit': int(round((section_object.getSpeed() * MPH_CONSTANT))), \
             'link-speed-limit-units': 'miles-per-hour'}
 
-def build_tmdd_map(model, organization_id, network_id, network_name):
+def is_circular_link(link):
+    """ A valid link must not be circular. """
+    return link['link-begin-node-id'] == link['link-end-node-id']
+
+def is_railroad_link(link):
+    """ A railway is not a valid link. """
+    return link['link-type'] == 'railroad link'
+
+def is_zero_length_link(link):
+    return link['link-length'] <= 0
+
+def duplicate_link_rule():
+    """
+    Returns a rule matching every link whose id was already seen by the rule. Only links that
+    passed every earlier rule reach it, so the first valid link with a given id is kept.
+    """
+    seen = set()
+    def is_duplicate_link(link):
+        if link['link-id'] in seen:
+            return True
+        seen.add(link['link-id'])
+        return False
+    return is_duplicate_link
+
+def link_rules():
+    """
+    The rules a link must not match to be exported, as (reason, predicate) pairs, in the order they are checked.
+    Add a pair here to filter another kind of invalid link.
+    """
+    return [('circular', is_circular_link),
+            ('railroad', is_railroad_link),
+            ('zero-length', is_zero_length_link),
+            ('duplicate id', duplicate_link_rule())]
+
+def validate_links(links, rules, removed):
+    """
+    Filters invalid links lazily, in a single pass. Each link is removed for the first rule it matches.
+    :param links: an iterable of (link inventory element, section object) pairs
+    :param rules: a list of (reason, predicate) pairs, see link_rules
+    :param removed: a dictionary mapping reason -> number removed, updated as links are filtered
+    :return: yields the valid pairs
+    """
+    for link, section_object in links:
+        reason = next((reason for reason, rule in rules if rule(link)), None)
+        if reason is None:
+            yield link, section_object
+        else:
+            removed[reason] = removed.get(reason, 0) + 1
+
+def iter_objects(model, type_name):
+    """ yields every object in the model of type_name or one of its subtypes. """
+    for types in model.getCatalog().getUsedSubTypesFromType(model.getType(type_name)):
+        for aimsun_object in types.itervalues():
+            yield aimsun_object
+
+def iter_tmdd_fields(model, organization_id, network_id, network_name, translator=None, update_time=None):
+    """
+    Extracts the tmdd network one element at a time. Yields (section, key, value) triples in document order,
+    where the value of each list key is an iterator over its elements. Each iterator must be consumed before
+    advancing to the next triple, as the node lists include the dummy nodes created while building the links.
+    :param translator: translates model coordinates to degrees, by default a GKCoordinateTranslator of the model
+    :param update_time: the last-update-time of every element, by default the time the export started
+    """
+    translator = translator if translator is not None else GKCoordinateTranslator(model)
+    update_time = update_time if update_time is not None else build_update_time()
+    locations = GeolocationCache(translator)
+
+    """ the sections that passed validation, and the status elements of dummy nodes, in the order they were built. """
+    kept_sections = []
+    dummy_nodes = []
+    dummy_status = []
+
     def build_node_inventory_element(junction_object):
         element = dict()
         element['network-id'] = network_id  # Required
         element['network-name'] = network_name  # Required
         element['node-id'] = str(junction_object.getId())  # Required 
         element['node-name'] = junction_object.getName()
-        element['node-location'] = build_geolocation(translator, junction_object.getPosition())
-        element['last-update-time'] = build_update_time()
+        element['node-location'] = locations.position(junction_object)
+        element['last-update-time'] = update_time
         # signalized = model.getType("GKNode").getColumn("GKNode:signalizedIntersection", GKType.eSearchOnlyThisType)
         # element['node-description'] = "Signalized" if signalized else "Not signalized"
         return element
@@ -85,20 +207,20 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         begin: boolean value; TRUE if dummy is an origin node, else FALSE
         """
         position = 'begin' if begin else 'end'
-        node_inventory.append({
+        dummy_nodes.append({
               'network-id': link_element['network-id'],
               'network-name': link_element['network-name'],
               'node-id': link_element['link-{0}-node-id'.format(position)],
               'node-name': 'dummy_{0}_{1}'.format(position, link_element['link-name']),
               'node-location': link_element['link-{0}-node-location'.format(position)],
-              'last-update-time': build_update_time()
+              'last-update-time': update_time
             })
-        node_status.append({
+        dummy_status.append({
               'network-id': link_element['network-id'],
               'network-name': link_element['network-name'],
               'node-id': link_element['link-{0}-node-id'.format(position)],
               'node-name': 'dummy_{0}_{1}'.format(position, link_element['link-name']),
-              'last-update-time': build_update_time(),
+              'last-update-time': update_time,
               'node-status': 'no determination'
             })
       
@@ -109,7 +231,7 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         element['network-name'] = network_name
         element['node-id'] = str(junction_object.getId())
         element['node-name'] = junction_object.getName()
-        element['last-update-time'] = build_update_time()
+        element['last-update-time'] = update_time
         element['node-status'] = 'no determination'
         return element 
 
@@ -127,14 +249,14 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         element['link-restrictions'] = build_link_restrictions(section_object)
 
         """ Build the link geometry, sans the source and target nodes. """
-        element['link-geom-location'] = [build_geolocation(translator, point) for point in section_object.calculatePolyline()]
+        element['link-geom-location'] = [locations.point(point) for point in section_object.calculatePolyline()]
 
         """ Find and update the source/target nodes, if they exist. If they do not exist, create a symbolic
         node with location equal to the beginning/end point in the link geometry. """
         begin_node = section_object.getOrigin()
         if begin_node is not None:
             element['link-begin-node-id'] = str(begin_node.getId())  # Required
-            element['link-begin-node-location'] = build_geolocation(translator, begin_node.getPosition())  # Required
+            element['link-begin-node-location'] = locations.position(begin_node)  # Required
             # city = model.getType("GKDPoint").getColumn("GKDPoint::CITY", GKType.eSearchOnlyThisType)
             # element['link-jurisdiction'] = begin_node.getDataValue(city)[0] if (begin_node.getDataValue(city)[0]) is not None else "Data not provided"
         else:
@@ -146,7 +268,7 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         end_node = section_object.getDestination()
         if end_node is not None:
             element['link-end-node-id'] = str(end_node.getId())  # Required
-            element['link-end-node-location'] = build_geolocation(translator, end_node.getPosition())  # Required
+            element['link-end-node-location'] = locations.position(end_node)  # Required
         else:
             DUMMY_ID = DUMMY_ID + 1
             element['link-end-node-id'] = 'dummy' + str(DUMMY_ID)
@@ -157,7 +279,7 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         element['link-geom-location'].append(element['link-end-node-location'])
         element['link-geom-location'].insert(0, element['link-begin-node-location'])
 
-        element['last-update-time'] = build_update_time()
+        element['last-update-time'] = update_time
 
         return element
 
@@ -167,7 +289,7 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         element['link-id'] = str(section_object.getId())  
         element['link-name'] = section_object.getName()
         element['link-status'] = 'no determination' 
-        element['last-update-time'] = build_update_time()
+        element['last-update-time'] = update_time
         element['lanes-number-open'] = section_object.getNbFullLanes()
         return element
 
@@ -180,79 +302,161 @@ def build_tmdd_map(model, organization_id, network_id, network_name):
         element['route-type'] = 'detour'  # All SubPaths in models are for rerouting traffic
         element['route-name'] = subpath_object.getName()
         element['route-length'] = int(round(subpath_object.length3D())) # units: meters
-        element['last-update-time'] = build_update_time()
+        element['last-update-time'] = update_time
         return element
 
-    link_inventory = []
-    link_status = []
-    node_inventory = []
-    node_status = []
-    route_inventory = []
-
-    for types in model.getCatalog().getUsedSubTypesFromType(model.getType('GKSection')):
-        for section_object in types.itervalues():
-            link_inventory.append(build_link_inventory_element(section_object))
-            link_status.append(build_link_status_element(section_object))
-
-    for types in model.getCatalog().getUsedSubTypesFromType(model.getType('GKNode')):
-        for junction_object in types.itervalues():
-            node_inventory.append(build_node_inventory_element(junction_object))
-            node_status.append(build_node_status_element(junction_object))
-
-    for types in model.getCatalog().getUsedSubTypesFromType(model.getType('GKSubPath')):
-        for subpath_object in types.itervalues():
+    def link_inventory():
+        """ Builds and filters invalid links. The status of each kept link is built afterwards from kept_sections. """
+        rules = link_rules()
+        removed = dict((reason, 0) for reason, _ in rules)
+        links = ((build_link_inventory_element(section_object), section_object)
+                 for section_object in iter_objects(model, 'GKSection'))
+        for element, section_object in validate_links(links, rules, removed):
+            kept_sections.append(section_object)
+            yield element
+
+        print('Kept', len(kept_sections), 'of', len(kept_sections) + sum(removed.values()), 'links')
+        for reason, _ in rules:
+            if removed[reason]:
+                print('  removed', removed[reason], reason, 'links')
+
+    def node_inventory():
+        for element in dummy_nodes:
+            yield element
+        for junction_object in iter_objects(model, 'GKNode'):
+            yield build_node_inventory_element(junction_object)
+
+    def node_status():
+        for element in dummy_status:
+            yield element
+        for junction_object in iter_objects(model, 'GKNode'):
+            yield build_node_status_element(junction_object)
+
+    def route_inventory():
+        for subpath_object in iter_objects(model, 'GKSubPath'):
             if reduce(lambda prev, name: prev or name in subpath_object.getName(), ['EB_', 'WB_'], False):
-                route_inventory.append(build_detour_route_inventory_element(subpath_object))
-
-    """ A valid link must not be circular. Find all circular links by looking through link_inventory. """
-    circular_links = reduce(
-        lambda redundant, link: redundant + [link['link-id']] if link['link-begin-node-id'] == link['link-end-node-id'] else redundant,
-        link_inventory,
-        list())
-
-    circular_link_predicate = lambda link: link['link-id'] not in circular_links
-
-
-    """ A railway is not a valid link. Filter out all railroad links. """
-    rail_links = reduce(
-        lambda railway, link: railway + [link['link-id']] if link['link-type'] == 'railroad link' else railway,
-        link_inventory,
-        list())
-
-    railroad_predicate = lambda link: link['link-id'] not in rail_links
-
-
-    """ Filter invalid links. """
-    link_inventory = list(filter(lambda link: circular_link_predicate(link) and railroad_predicate(link), link_inventory))
-    link_status = list(filter(lambda link: circular_link_predicate(link) and railroad_predicate(link), link_status))
-
-
-    return {'LinkInventory': {'organization-information': build_organization_information(organization_id),
-                              'link-inventory-list': link_inventory},
-            'LinkStatus': {'organization-information': build_organization_information(organization_id),
-                              'link-status-list': link_status},
-            'NodeInventory': {'organization-information': build_organization_information(organization_id),
-                              'node-inventory-list': node_inventory},
-            'NodeStatus': {'organization-information': build_organization_information(organization_id),
-                              'node-status-list': node_status},
-            'RouteInventory': {'organization-information': build_organization_information(organization_id), 
-                              'route-inventory-list': route_inventory}}
+                yield build_detour_route_inventory_element(subpath_object)
+
+    organization_information = build_organization_information(organization_id, update_time)
+    yield 'LinkInventory', 'organization-information', organization_information
+    yield 'LinkInventory', 'link-inventory-list', link_inventory()
+    yield 'LinkStatus', 'organization-information', organization_information
+    yield 'LinkStatus', 'link-status-list', (build_link_status_element(s) for s in kept_sections)
+    yield 'NodeInventory', 'organization-information', organization_information
+    yield 'NodeInventory', 'node-inventory-list', node_inventory()
+    yield 'NodeStatus', 'organization-information', organization_information
+    yield 'NodeStatus', 'node-status-list', node_status()
+    yield 'RouteInventory', 'organization-information', organization_information
+    yield 'RouteInventory', 'route-inventory-list', route_inventory()
+
+def build_tmdd_map(model, organization_id, network_id, network_name, translator=None, update_time=None):
+    """
+    Extracts the whole tmdd network as nested dictionaries, see iter_tmdd_fields.
+    """
+    tmdd_map = dict()
+    for section, key, value in iter_tmdd_fields(model, organization_id, network_id, network_name,
+                                                translator, update_time):
+        tmdd_map.setdefault(section, dict())[key] = list(value) if key in LIST_KEYS else value
+    return tmdd_map
 
 def separator():
     return WINDOWS_ENCODING if SYSTEM_TYPE == 'windows' else UNIX_ENCODING
 
 def build_json(model, path, filename, organization_id, network_id, network_name):
+    tmdd_path = path + separator() + filename + '.json'
+    print('Writing', tmdd_path + ('.gz' if GZIP else ''))
+
+    if not INCREMENTAL or incremental is None:
+        if INCREMENTAL:
+            print('incremental.py is not on the python path, writing the full network only')
+        """ elements are extracted and written in batches, so the network is never held in memory. """
+        write_json_stream(iter_tmdd_fields(model, organization_id, network_id, network_name), tmdd_path)
+        return
+
+    """ the manifest and delta compare whole sections, so the network is held in memory. """
     tmdd_map = build_tmdd_map(model, organization_id, network_id, network_name)
+    write_json_stream(map_fields(tmdd_map), tmdd_path)
+    write_delta_json(tmdd_map, path, filename)
+
+def map_fields(tmdd_map):
+    """ the (section, key, value) triples of a tmdd map, as yielded by iter_tmdd_fields. """
+    for section in SECTIONS:
+        if section in tmdd_map:
+            for key, value in tmdd_map[section].items():
+                yield section, key, iter(value) if key in LIST_KEYS else value
+
+def write_batch(text_file, batch, count, layout):
+    """ writes encoded elements after the count already written to a list, and returns the new count. """
+    if batch:
+        text_file.write((layout['first_record'] if count == 0 else layout['next_record']) +
+                        layout['next_record'].join(batch))
+    return count + len(batch)
+
+def open_output(tmdd_path):
+    """ opens tmdd_path for writing text, or tmdd_path.gz if GZIP. """
+    if GZIP:
+        return codecs.getwriter('utf-8')(gzip.open(tmdd_path + '.gz', 'wb'))
+    return open(tmdd_path, 'w')
+
+def write_json_stream(fields, tmdd_path):
+    """
+    Writes (section, key, value) triples as json, encoding the elements of each list BATCH_SIZE at a time
+    and printing the progress after each batch. The output parses to the same document as
+    json.dumps(tmdd_map, indent=2), or has no whitespace if COMPACT.
+    """
+    layout = LAYOUTS[COMPACT]
+    encode = lambda value, prefix: json.dumps(value, **layout['options']).replace('\n', '\n' + prefix)
+
+    with open_output(tmdd_path) as text_file:
+        current = None
+        for section, key, value in fields:
+            if section != current:
+                text_file.write(layout['open'] if current is None else layout['next_section'])
+                text_file.write(layout['section'].format(json.dumps(section)))
+                current = section
+            else:
+                text_file.write(layout['next_field'])
+            text_file.write(layout['field'].format(json.dumps(key)))
+
+            if key not in LIST_KEYS:
+                text_file.write(encode(value, layout['field_indent']))
+                continue
+
+            text_file.write('[')
+            count = 0
+            batch = []
+            for element in value:
+                batch.append(encode(element, layout['record_indent']))
+                if len(batch) == BATCH_SIZE:
+                    count = write_batch(text_file, batch, count, layout)
+                    batch = []
+                    print('  {0}: {1} elements written'.format(key, count))
+            count = write_batch(text_file, batch, count, layout)
+            text_file.write(layout['close_list'] if count else ']')
+            print('  {0}: {1} elements'.format(key, count))
+        text_file.write('{}' if current is None else layout['close'])
+
+def write_delta_json(tmdd_map, path, filename):
+    """
+    Compares each element against the manifest of the previous export of filename, and writes the
+    added and modified elements to filename_delta.json. The manifest is then replaced.
+    """
+    manifest_path = path + separator() + filename + '.manifest'
+    manifest = incremental.build_manifest(tmdd_map)
+    changes = incremental.diff_manifests(incremental.read_manifest(manifest_path), manifest)
 
-    tmdd_json = json.dumps(tmdd_map, indent=2)
+    delta_path = path + separator() + filename + '_delta.json'
+    print('Writing', delta_path + ('.gz' if GZIP else ''))
+    print(incremental.summarize(changes))
+    write_json_stream(map_fields(incremental.build_delta(tmdd_map, changes)), delta_path)
+    incremental.write_manifest(manifest, manifest_path)
 
-    tmdd_path = path + separator() + filename + '.json'
-    print 'Writing', tmdd_path
-    with open (tmdd_path, 'w') as text_file:
-        text_file.write(tmdd_json)
+def main():
+    gui=GKGUISystem.getGUISystem().getActiveGui()
+    model = gui.getActiveModel()
 
-gui=GKGUISystem.getGUISystem().getActiveGui()
-model = gui.getActiveModel()
+    path = os.getenv('APPDATA') + separator() + 'Aimsun' + separator() + 'Aimsun Next' + separator() + '8.2.0' + separator() + 'shared'
+    build_json(model, path, 'tmdd_v04', 'PATH Connected Corridors', '2018-10-4e', 'I-210 Pilot Aimsun TMDD Network v04')
 
-path = os.getenv('APPDATA') + separator() + 'Aimsun' + separator() + 'Aimsun Next' + separator() + '8.2.0' + separator() + 'shared'
-build_json(model, path, 'tmdd_v04', 'PATH Connected Corridors', '2018-10-4e', 'I-210 Pilot Aimsun TMDD Network v04')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import local_io as io
+import correct_distortion as cd
+import export_coordinate_csv as export
+import simplify
+from network import Network
+
+""" times and memory profiles correction, export and i/o on synthetic tmdd networks. run from the repository directory. """
+
+MIN_LON, MAX_LON = -118.16, -118.08
+MIN_LAT, MAX_LAT = 34.12, 34.17
+# the extent of the control points in aimsun_samples.csv
+DUMMY_FRACTION = 0.05
+# the fraction of link ends without a junction, which the aimsun exporter gives a dummy node
+POINT_SAMPLE = 100000
+# correct_point is timed on at most this many points
+SIMPLIFY_METRES = 1.0
+# the tolerance simplify_model is timed with
+
+
+def build_update_time():
+    now = datetime.datetime.now()
+    return {'date': now.strftime("%Y%m%d"), 'time': now.strftime("%H%M%S%f")[:10]}
+
+
+def generate_network(link_count, vertices=8, seed=0):
+    """
+    Generates a synthetic tmdd document laid out like the aimsun exporter's output. Junctions sit on a square
+    grid spanning the control point extent, and each link joins two neighbouring junctions with vertices - 2
+    jittered interior points. A DUMMY_FRACTION of link ends have no junction and get a dummy node instead.
+    :param link_count: the number of links
+    :param vertices: the number of points in each link-geom-location, including both ends
+    """
+    r = random.Random(seed)
+    side = max(2, int(np.ceil(np.sqrt(link_count / 2.0))) + 1)
+    lon_step = (MAX_LON - MIN_LON) / (side - 1)
+    lat_step = (MAX_LAT - MIN_LAT) / (side - 1)
+
+    def location(row, column):
+        return {'longitude': MIN_LON + column * lon_step, 'latitude': MIN_LAT + row * lat_step}
+
+    network = {'network-id': 'synthetic', 'network-name': 'Synthetic TMDD Network'}
+    link_inventory, link_status, node_inventory, node_status = [], [], [], []
+    dummy_id = 0
+    used = set()
+
+    for i in range(link_count):
+        row, column = divmod((i // 2) % ((side - 1) * (side - 1)), side - 1)
+        end = (row, column + 1) if i % 2 == 0 else (row + 1, column)
+        nodes = [(row, column), end]
+        begin_location, end_location = location(*nodes[0]), location(*nodes[1])
+
+        geometry = [begin_location]
+        for k in range(1, vertices - 1):
+            t = k / float(vertices - 1)
+            geometry.append({'longitude': begin_location['longitude'] * (1 - t) + end_location['longitude'] * t
+                                          + r.uniform(-1e-5, 1e-5),
+                             'latitude': begin_location['latitude'] * (1 - t) + end_location['latitude'] * t
+                                         + r.uniform(-1e-5, 1e-5)})
+        geometry.append(end_location)
+
+        link = dict(network)
+        link.update({'link-id': str(100000 + i),
+                     'link-name': 'synthetic link {0}'.format(i),
+                     'link-type': r.choice(['arterial', 'freeway', 'on-ramp', 'off-ramp']),
+                     'link-capacity': r.choice([900, 1800, 2000]),
+                     'link-length': r.randint(20, 800),
+                     'link-restrictions': {'link-speed-limit': r.choice([25, 35, 45, 65]),
+                                           'link-speed-limit-units': 'miles-per-hour'},
+                     'link-geom-location': geometry})
+        for position, node, point in (('begin', nodes[0], geometry[0]), ('end', nodes[1], geometry[-1])):
+            if r.random() < DUMMY_FRACTION:
+                dummy_id += 1
+                node_id = 'dummy' + str(dummy_id)
+                node_inventory.append(dict(network, **{'node-id': node_id,
+                                                       'node-name': 'dummy_{0}_{1}'.format(position, link['link-name']),
+                                                       'node-location': point,
+                                                       'last-update-time': build_update_time()}))
+                node_status.append(dict(network, **{'node-id': node_id,
+                                                    'node-name': 'dummy_{0}_{1}'.format(position, link['link-name']),
+                                                    'last-update-time': build_update_time(),
+                                                    'node-status': 'no determination'}))
+            else:
+                node_id = str(node[0] * side + node[1])
+                used.add(node)
+            link['link-{0}-node-id'.format(position)] = node_id
+            link['link-{0}-node-location'.format(position)] = point
+        link['last-update-time'] = build_update_time()
+        link_inventory.append(link)
+        link_status.append({'network-id': network['network-id'], 'link-id': link['link-id'],
+                            'link-name': link['link-name'], 'link-status': 'no determination',
+                            'last-update-time': build_update_time(), 'lanes-number-open': r.randint(1, 5)})
+
+    for node in sorted(used):
+        node_id = str(node[0] * side + node[1])
+        node_inventory.append(dict(network, **{'node-id': node_id, 'node-name': 'junction ' + node_id,
+                                               'node-location': location(*node),
+                                               'last-update-time': build_update_time()}))
+        node_status.append(dict(network, **{'node-id': node_id, 'node-name': 'junction ' + node_id,
+                                            'last-update-time': build_update_time(),
+                                            'node-status': 'no determination'}))
+
+    organization = {'organization-id': 'synthetic', 'last-update-time': build_update_time()}
+    """ round trip through json so that shared location dictionaries become independent, as when read from a file. """
+    return json.loads(json.dumps({
+        'LinkInventory': {'organization-information': organization, 'link-inventory-list': link_inventory},
+        'LinkStatus': {'organization-information': organization, 'link-status-list': link_status},
+        'NodeInventory': {'organization-information': organization, 'node-inventory-list': node_inventory},
+        'NodeStatus': {'organization-information': organization, 'node-status-list': node_status},
+        'RouteInventory': {'organization-information': organization, 'route-inventory-list': []}}))
+
+
+def network_coordinates(tmdd_object):
+    links = tmdd_object['LinkInventory']['link-inventory-list']
+    nodes = tmdd_object['NodeInventory']['node-inventory-list']
+    points = [link[field] for link in links for field in ('link-begin-node-location', 'link-end-node-location')]
+    points += [p for link in links for p in link['link-geom-location']]
+    points += [node['node-location'] for node in nodes]
+    return points
+
+
+def quietly(run):
+    """ wraps run so that it does not print, e.g. the zone summaries printed by CorrectionZone. """
+    def wrapped(argument):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return run(argument)
+    return wrapped
+
+
+def measure(stage, items, run, setup=None, repeat=3, memory=True):
+    """
+    Times run(setup()) repeat times and keeps the fastest. If memory, one more traced run records the peak
+    number of bytes allocated by python and numpy during run.
+    :return: a dictionary describing the stage
+    """
+    best = None
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        run(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {'stage': stage, 'items': items, 'seconds': best,
+              'items_per_second': items / best if best else None}
+    if memory:
+        argument = setup() if setup is not None else None
+        tracemalloc.start()
+        run(argument)
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def benchmark_scale(link_count, vertices, directory, repeat, memory):
+    """
+    runs every stage on one synthetic network.
+    :return: a list of stage results
+    """
+    results = []
+
+    def record(stage, items, run, setup=None):
+        result = measure(stage, items, run, setup, repeat, memory)
+        print('  {0:<24} {1:>10} items {2:>10.4f}s {3}'.format(
+            stage, items, result['seconds'],
+            '{0:.1f} MiB peak'.format(result['peak_bytes'] / 2.0 ** 20) if 'peak_bytes' in result else ''))
+        results.append(result)
+
+    tmdd_object = generate_network(link_count, vertices)
+    tmdd_json = json.dumps(tmdd_object, indent=2)
+    fresh = lambda: json.loads(tmdd_json)
+    points = network_coordinates(tmdd_object)
+    coordinates = np.array([(p['longitude'], p['latitude']) for p in points])
+    filename = 'synthetic_{0}'.format(link_count)
+    filepath = directory + io.separator() + filename + '.json'
+    segments = sum(len(link['link-geom-location']) - 1 for link in tmdd_object['LinkInventory']['link-inventory-list'])
+
+    cz = quietly(lambda _: cd.CorrectionZone(2, 1, cache=False))(None)
+    record('zone_fit', 1, quietly(lambda _: cd.CorrectionZone(2, 1, cache=False)))
+    record('adaptive_zone_fit', 1, quietly(lambda _: cd.AdaptiveCorrectionZone(8, cache=False)))
+
+    sample = points[:POINT_SAMPLE]
+    record('correct_point', len(sample), lambda _: [cz.correct_point(p, cd.FORMAT) for p in sample])
+    record('correct_points', len(coordinates), lambda _: cz.correct_points(coordinates))
+    record('correct_network', len(points), lambda tmdd: cd.correct_network(cz, tmdd, cd.FORMAT), fresh)
+    record('network_from_tmdd', link_count, lambda tmdd: Network.from_tmdd(tmdd), fresh)
+    record('correct_model', len(points), lambda network: cd.correct_model(cz, network, cd.FORMAT),
+           lambda: Network.from_tmdd(fresh()))
+    record('simplify_model', len(points), lambda network: simplify.simplify_model(network, SIMPLIFY_METRES),
+           lambda: Network.from_tmdd(fresh()))
+
+    record('json_dumps', link_count, lambda _: json.dumps(tmdd_object, indent=2))
+    record('write_tmdd_json', link_count, lambda _: io.write_tmdd_json(tmdd_object, directory, filename))
+    record('write_tmdd_json_compact', link_count,
+           lambda _: io.write_tmdd_json(tmdd_object, directory, filename + '_compact', compact=True))
+    record('write_tmdd_json_gzip', link_count,
+           lambda _: io.write_tmdd_json(tmdd_object, directory, filename + '_gzip', compress=True))
+    if io.orjson is not None:
+        record('write_tmdd_json_fast', link_count,
+               lambda _: io.write_tmdd_json(tmdd_object, directory, filename + '_fast', fast=True))
+    record('json_loads', link_count, lambda _: json.loads(tmdd_json))
+    record('iter_tmdd', link_count, lambda _: [list(v) if hasattr(v, '__next__') else v
+                                               for _, _, v in io.iter_tmdd(filepath)])
+
+    def export_csv(_):
+        with open(os.devnull, 'w', newline='\n') as f:
+            writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(export.HEADER)
+            writer.writerows(export.segment_rows(iter(tmdd_object['LinkInventory']['link-inventory-list'])))
+    record('export_csv', segments, export_csv)
+
+    for result in results:
+        result.update({'links': link_count, 'vertices': vertices})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-links", type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="the number of links in each synthetic network")
+    parser.add_argument("-vertices", type=int, default=8,
+                        help="the number of points in each link's geometry, including both ends")
+    parser.add_argument("-repeat", type=int, default=3,
+                        help="time each stage this many times and keep the fastest")
+    parser.add_argument("-no-memory", action="store_true",
+                        help="skip the traced run that measures peak memory")
+    parser.add_argument("-output", default='benchmark_results.json',
+                        help="where the results are written as json")
+    args = parser.parse_args()
+
+    assert args.vertices >= 2, "-vertices must be at least 2."
+
+    directory = tempfile.mkdtemp(prefix='tmdd_benchmark')
+    results = []
+    try:
+        for link_count in args.links:
+            print('{0} links, {1} vertices per link'.format(link_count, args.vertices))
+            results += benchmark_scale(link_count, args.vertices, directory, args.repeat, not args.no_memory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'timestamp': datetime.datetime.now().isoformat(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'platform': platform.platform(),
+                   'results': results}, f, indent=2)
+    print('Writing', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+import local_io as io
+from network import MISSING
+
+"""
+a columnar binary layout for the link and node inventories of a tmdd network.
+
+a network named key is stored in the directory key.columns, holding one .npy file per array and a
+header.json describing them. .npy files are raw arrays behind a small header, so they can be loaded
+with np.memmap (np.load with mmap_mode) without copying.
+
+    header.json             format version, the rest of the tmdd document, and the column layout
+    link_coordinates.npy    (V, 2) every link-geom-location vertex, link after link
+    link_offsets.npy        (L + 1,) link i's vertices are link_coordinates[offsets[i]:offsets[i + 1]]
+    link_begin.npy          (L, 2) link-begin-node-location
+    link_end.npy            (L, 2) link-end-node-location
+    node_location.npy       (N, 2) node-location
+    link_<i>.npy            (L,) the ith scalar link attribute, e.g. link-id or link-restrictions.link-speed-limit
+    node_<i>.npy            (N,) the ith scalar node attribute
+    link_extras.json        per-link fields that do not fit a column, if any
+    node_extras.json        per-node fields that do not fit a column, if any
+
+coordinates keep their dtype: int64 for TMDD formatted networks, float64 otherwise.
+"""
+
+COLUMNAR_EXTENSION = '.columns'
+FORMAT_VERSION = 1
+
+INVENTORIES = {
+    'link': ('LinkInventory', 'link-inventory-list',
+             {'link-geom-location': None, 'link-begin-node-location': 'link_begin', 'link-end-node-location': 'link_end'}),
+    'node': ('NodeInventory', 'node-inventory-list',
+             {'node-location': 'node_location'}),
+}
+# kind -> (section, list key, location fields mapped to their array)
+
+
+def get_columnar_files(path='data'):
+    """
+    Returns the names of the columnar networks in a directory, relative to it.
+    """
+    return sorted(d for d in os.listdir(io.get_script_path(path))
+                  if d.endswith(COLUMNAR_EXTENSION) and not io.is_delta(d))
+
+
+def _flatten(record, skip, prefix=()):
+    """ yields (key path, value) for each scalar field of a record, descending into nested dictionaries. """
+    for key, value in record.items():
+        if not prefix and key in skip:
+            continue
+        if isinstance(value, dict) and value:
+            yield from _flatten(value, skip, prefix + (key,))
+        else:
+            yield prefix + (key,), value
+
+
+def _column(values):
+    """ an array for a list of json scalars, or None if they do not share one lossless dtype. """
+    kinds = {type(v) for v in values}
+    if kinds == {str}:
+        return np.array(values, dtype=str)
+    if kinds == {int}:
+        return np.array(values, dtype=np.int64)
+    if kinds == {float}:
+        return np.array(values, dtype=float)
+    return None
+
+
+def _points(points):
+    return np.array([(p['longitude'], p['latitude']) for p in points]).reshape(-1, 2)
+
+
+class NetworkColumns:
+    def __init__(self, header, arrays, extras):
+        """
+        The link and node inventory of a tmdd network as flat arrays. Use from_tmdd or read to build one.
+        :param header: the format version, the rest of the tmdd document and the column layout
+        :param arrays: maps array name -> np.ndarray, named as in the module docstring
+        :param extras: maps 'link'/'node' -> a list of per-record fields that are not columns
+        """
+        self.header = header
+        self.arrays = arrays
+        self.extras = extras
+
+    @property
+    def link_count(self):
+        return self.header['link']['count']
+
+    @property
+    def node_count(self):
+        return self.header['node']['count']
+
+    @classmethod
+    def from_tmdd(cls, tmdd_object):
+        document = {section: dict(fields) for section, fields in tmdd_object.items()}
+        header = {'version': FORMAT_VERSION, 'document': document}
+        arrays = {}
+        extras = {}
+
+        for kind, (section, list_key, locations) in INVENTORIES.items():
+            records = document[section][list_key]
+            document[section][list_key] = None
+
+            for field, name in locations.items():
+                if name is not None:
+                    arrays[name] = _points([record[field] for record in records])
+            if kind == 'link':
+                geometry = [record['link-geom-location'] for record in records]
+                arrays['link_coordinates'] = _points([p for points in geometry for p in points])
+                arrays['link_offsets'] = np.concatenate(([0], np.cumsum([len(g) for g in geometry]))).astype(np.int64)
+
+            """ every scalar field, in order of first appearance. the order is kept so records rebuild identically. """
+            paths = {}
+            for record in records:
+                for path, _ in _flatten(record, locations):
+                    paths.setdefault(path, None)
+
+            columns = []
+            extra_paths = []
+            for path in paths:
+                values = [record for record in records]
+                for key in path:
+                    values = [v.get(key, MISSING) if isinstance(v, dict) else MISSING for v in values]
+                column = None if MISSING in values else _column(values)
+                if column is None:
+                    extra_paths.append(path)
+                else:
+                    arrays['{0}_{1}'.format(kind, len(columns))] = column
+                    columns.append(list(path))
+
+            extras[kind] = []
+            if extra_paths:
+                for record in records:
+                    present = {}
+                    for path in extra_paths:
+                        value = record
+                        for key in path:
+                            value = value.get(key, MISSING) if isinstance(value, dict) else MISSING
+                        if value is not MISSING:
+                            present['\x1f'.join(path)] = value
+                    extras[kind].append(present)
+
+            header[kind] = {'count': len(records),
+                            'fields': [field for field in records[0]] if records else list(locations),
+                            'columns': columns,
+                            'extras': ['\x1f'.join(path) for path in extra_paths]}
+
+        return cls(header, arrays, extras)
+
+    def to_tmdd(self):
+        """
+        Rebuilds the tmdd document as nested dictionaries.
+        """
+        tmdd_object = json.loads(json.dumps(self.header['document']))
+        for kind, (section, list_key, locations) in INVENTORIES.items():
+            tmdd_object[section][list_key] = self.__records(kind, locations)
+        return tmdd_object
+
+    def __records(self, kind, locations):
+        layout = self.header[kind]
+        count = layout['count']
+        columns = {tuple(path): self.arrays['{0}_{1}'.format(kind, i)].tolist()
+                   for i, path in enumerate(layout['columns'])}
+        points = {name: self.arrays[name].tolist() for name in locations.values() if name is not None}
+        if kind == 'link':
+            coordinates = self.arrays['link_coordinates'].tolist()
+            offsets = self.arrays['link_offsets'].tolist()
+        extras = self.extras.get(kind) or [{} for _ in range(count)]
+
+        """ records take the key order of the first record, followed by any fields it lacked. """
+        top_level = [path[0] for path in layout['columns']] + [path.split('\x1f')[0] for path in layout['extras']]
+        fields = list(layout['fields']) + [field for field in dict.fromkeys(top_level) if field not in layout['fields']]
+
+        records = []
+        for i in range(count):
+            record = {}
+            values = {path: column[i] for path, column in columns.items()}
+            values.update((tuple(path.split('\x1f')), value) for path, value in extras[i].items())
+            for field in fields:
+                if field in locations:
+                    name = locations[field]
+                    if name is None:
+                        record[field] = [{'longitude': lon, 'latitude': lat}
+                                         for lon, lat in coordinates[offsets[i]:offsets[i + 1]]]
+                    else:
+                        lon, lat = points[name][i]
+                        record[field] = {'longitude': lon, 'latitude': lat}
+                elif (field,) in values:
+                    record[field] = values[(field,)]
+                else:
+                    nested = _nest([(path[1:], value) for path, value in values.items()
+                                    if len(path) > 1 and path[0] == field])
+                    if nested:
+                        record[field] = nested
+            records.append(record)
+        return records
+
+    def write(self, path, filename):
+        """
+        Writes the network to a new directory that then replaces any earlier copy, as read loads every
+        file in it and must not pick up the columns or extras of an earlier network.
+        """
+        directory = path + io.separator() + filename + COLUMNAR_EXTENSION
+        staging = directory + '.tmp'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        with open(staging + io.separator() + 'header.json', 'w') as f:
+            json.dump(self.header, f)
+        for name, array in self.arrays.items():
+            np.save(staging + io.separator() + name + '.npy', np.ascontiguousarray(array))
+        for kind, extras in self.extras.items():
+            if extras:
+                with open(staging + io.separator() + kind + '_extras.json', 'w') as f:
+                    json.dump(extras, f)
+
+        if os.path.isdir(directory):
+            stale = directory + '.old'
+            shutil.rmtree(stale, ignore_errors=True)
+            os.rename(directory, stale)
+            os.rename(staging, directory)
+            shutil.rmtree(stale, ignore_errors=True)
+        else:
+            os.rename(staging, directory)
+
+    @classmethod
+    def read(cls, path, filename, mmap=True):
+        """
+        :param filename: the network name, with or without COLUMNAR_EXTENSION
+        :param mmap: if true, arrays are memory mapped read only rather than loaded
+        """
+        if not filename.endswith(COLUMNAR_EXTENSION):
+            filename += COLUMNAR_EXTENSION
+        directory = path + io.separator() + filename
+        with open(directory + io.separator() + 'header.json', 'r') as f:
+            header = json.load(f)
+        assert header['version'] == FORMAT_VERSION, 'unsupported columnar format version {0}'.format(header['version'])
+
+        arrays = {}
+        extras = {}
+        for file in os.listdir(directory):
+            name, extension = file.rsplit('.', 1)
+            if extension == 'npy':
+                arrays[name] = np.load(directory + io.separator() + file, mmap_mode='r' if mmap else None)
+            elif name.endswith('_extras'):
+                with open(directory + io.separator() + file, 'r') as f:
+                    extras[name[:-len('_extras')]] = json.load(f)
+        return cls(header, arrays, extras)
+
+
+def _nest(items):
+    """ rebuilds a nested dictionary from (key path, value) pairs, in order. """
+    nested = {}
+    for path, value in items:
+        target = nested
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    return nested
+
+
+def main():
+    parser = argparse.ArgumentParser(description='converts networks in the data directory between tmdd .json '
+                                                 'and the columnar format.')
+    parser.add_argument("-to-columns", action="store_true",
+                        help="write a columnar copy of every .json network")
+    parser.add_argument("-to-json", action="store_true",
+                        help="write a tmdd .json copy of every columnar network")
+    args = parser.parse_args()
+
+    assert args.to_columns != args.to_json, "exactly one of -to-columns, -to-json is required."
+
+    path = io.get_script_path('data')
+    if args.to_columns:
+        for key, tmdd_json in io.iter_JSON_strings():
+            print('Writing', key + COLUMNAR_EXTENSION)
+            NetworkColumns.from_tmdd(json.loads(tmdd_json)).write(path, key)
+    else:
+        for file in get_columnar_files():
+            key = file[:-len(COLUMNAR_EXTENSION)]
+            print('Writing', key + '.json')
+            io.write_tmdd_json(NetworkColumns.read(path, file).to_tmdd(), path, key)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,146 @@
 import copy
 import csv
+import hashlib
 import itertools
 import json
 import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+import zipfile
 
 import numpy as np
 
+import export_coordinate_csv as export
+import incremental
 import local_io as io
+import profiling
+import simplify
+from columnar import COLUMNAR_EXTENSION, NetworkColumns, get_columnar_files
+from network import DIGIT_PRECISION, Network, compact_coordinates
 
-DIGIT_PRECISION = 7
 FORMAT = True
 # if true, formats lon and lat to TMDD standards
+BATCH_SIZE = 10000
+# number of records corrected together in -stream mode
+CACHE_DIRECTORY = 'cache'
+# where fitted zones are stored between runs
+CACHE_ENTRIES = 16
+# the number of zone configurations kept in CACHE_DIRECTORY
+MANIFEST_EXTENSION = '.manifest'
+# suffix of the content hash manifest written next to each network corrected with -incremental
+WATCH_INTERVAL = 1.0
+# seconds between polls of the data directory and sample files in -watch mode
+SAMPLE_FILES = ('aimsun_samples.csv', 'google_samples.csv')
+# the control points every zone is fit to
+
+
+def affine_rows(points, matrices):
+    """
+    lon * m[0] + lat * m[1] + m[2] for each [lon, lat] row and 3x2 matrix, computed elementwise. unlike a matmul,
+    whose blocking can round the same row differently at different positions, equal rows give equal bits.
+    :param matrices: one (3, 2) matrix for every row, or a single (3, 2) matrix for all of them
+    """
+    matrices = np.asarray(matrices)
+    return points[:, :1] * matrices[..., 0, :] + points[:, 1:] * matrices[..., 1, :] + matrices[..., 2, :]
+
+
+def load_data(file):
+    with open(file + '.csv', 'r') as f:
+        return list(map(lambda p: [float(v) for v in p], csv.reader(f)))
+
+
+def cache_path(layout):
+    """
+    the cache file for a zone layout, named by a hash of both sample files and the layout.
+    :param layout: a string identifying the zone configuration, e.g. '2x1'
+    """
+    digest = hashlib.sha256()
+    for file in ('aimsun_samples', 'google_samples'):
+        with open(file + '.csv', 'rb') as f:
+            digest.update(f.read())
+    digest.update(layout.encode())
+    return os.path.join(CACHE_DIRECTORY, 'zones_' + digest.hexdigest()[:32] + '.npz')
+
+
+def load_cache(path, names):
+    """
+    :param names: the arrays the entry must hold
+    :return: a dictionary of the arrays stored at path, or None if there is no usable cache entry. an entry
+    that is missing, truncated or lacks one of names is a miss, and is replaced once the zones are refit.
+    """
+    try:
+        with np.load(path) as cached:
+            arrays = {name: cached[name] for name in names}
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        return None
+    """ mark the entry as recently used, so eviction removes older configurations first. """
+    os.utime(path)
+    return arrays
+
+
+def save_cache(path, **arrays):
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    """ written beside the entry and moved into place, so an interrupted write never leaves a truncated entry. """
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIRECTORY, suffix='.tmp', delete=False) as f:
+        try:
+            np.savez(f, **arrays)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+    """ evict the least recently used configurations beyond CACHE_ENTRIES. """
+    entries = [os.path.join(CACHE_DIRECTORY, f) for f in os.listdir(CACHE_DIRECTORY) if f.startswith('zones_')]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for stale in entries[CACHE_ENTRIES:]:
+        os.remove(stale)
+
 
 class CorrectionZone:
-    def __init__(self, horizontal_zones=1, vertical_zones=1):
+    def __init__(self, horizontal_zones=1, vertical_zones=1, cache=True):
         """
         :param horizontal_zones: the number of zones that should exist along the x axis
         :param vertical_zones: the number of zones that should exist along the y axis
+        :param cache: if true, reuse the fitted zones stored in CACHE_DIRECTORY when neither sample file
+        nor the zone counts have changed, and store them there otherwise
          _ _ _
         |_|_|_|
         |_|_|_|
         A region with three horizontal zones and two vertical zones. A horizontal zone is formed
         by two vertical lines. A vertical zone is formed by two horizontal lines.
         """
-        """ manually collected points. the ith point in each list corresponds to the ith sample. """
-        source_samples = self.__load_data('aimsun_samples')
-        target_samples = self.__load_data('google_samples')
-
         self.horizontal_zones = horizontal_zones
         self.vertical_zones = vertical_zones
+        self.layout = '{0}x{1}'.format(horizontal_zones, vertical_zones)
+
+        path = cache_path(self.layout) if cache else None
+        cached = load_cache(path, ('transformation_matrices', 'lon_bounds', 'lat_bounds')) if path is not None else None
+        if cached is not None:
+            self.transformation_matrices = [list(row) for row in cached['transformation_matrices']]
+            self.lon_bounds = cached['lon_bounds'].tolist()
+            self.lat_bounds = cached['lat_bounds'].tolist()
+            print('loaded {0} horizontal and {1} vertical zones from {2}'
+                  .format(horizontal_zones, vertical_zones, path))
+            return
+
+        self.__fit()
+
+        if path is not None:
+            save_cache(path,
+                       transformation_matrices=np.array(self.transformation_matrices, dtype=float),
+                       lon_bounds=np.array(self.lon_bounds, dtype=float),
+                       lat_bounds=np.array(self.lat_bounds, dtype=float))
+
+    def __fit(self):
+        """ manually collected points. the ith point in each list corresponds to the ith sample. """
+        source_samples = load_data('aimsun_samples')
+        target_samples = load_data('google_samples')
+
+        horizontal_zones = self.horizontal_zones
+        vertical_zones = self.vertical_zones
 
         """ compute the min/max lon/lats to bounds for each zone. """
         min_lon = min(source_samples, key=lambda p: p[0])[0]
@@ -102,10 +214,35 @@ class CorrectionZone:
             to_return = format_coordinate(to_return)
         return to_return
 
-    @staticmethod
-    def __load_data(file):
-        with open(file + '.csv', 'r') as f:
-            return list(map(lambda p: [float(v) for v in p], csv.reader(f)))
+    def bucket_indices(self, points):
+        """
+        vectorized equivalent of __bucket_index.
+        :param points: an (N, 2) array of [lon, lat] rows
+        :return: two integer arrays of length N, the lat and lon indices of each point's bucket
+        """
+        points = np.asarray(points, dtype=float)
+        lon_index = np.searchsorted(self.lon_bounds, points[:, 0], side='left')
+        lat_index = np.searchsorted(self.lat_bounds, points[:, 1], side='left')
+        np.minimum(lon_index, len(self.lon_bounds) - 1, out=lon_index)
+        np.minimum(lat_index, len(self.lat_bounds) - 1, out=lat_index)
+        return lat_index, lon_index
+
+    def correct_points(self, points):
+        """
+        corrects many points at once. each zone's matrix is applied to all of its points at once, see affine_rows.
+        :param points: an (N, 2) array of [lon, lat] rows
+        :return: an (N, 2) float array of corrected [lon, lat] rows
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        corrected = np.empty_like(points)
+
+        lat_index, lon_index = self.bucket_indices(points)
+        zone = lat_index * self.horizontal_zones + lon_index
+        for i, j in itertools.product(range(self.vertical_zones), range(self.horizontal_zones)):
+            mask = zone == i * self.horizontal_zones + j
+            if mask.any():
+                corrected[mask] = affine_rows(points[mask], self.transformation_matrices[i][j])
+        return corrected
 
     @staticmethod
     def __find_bounds(minimum, maximum, zone_count):
@@ -119,6 +256,126 @@ class CorrectionZone:
         return [minimum + (i * bucket_size) for i in range(1, zone_count + 1)]
 
 
+class AdaptiveCorrectionZone:
+    def __init__(self, min_samples=8, cache=True):
+        """
+        Partitions the control points with a k-d tree instead of a uniform grid. The extent of the
+        points is split at the median of its wider axis, recursively, until a split would leave a zone
+        with fewer than min_samples control points. Dense areas get small zones and sparse areas large
+        ones, and no zone falls back to a degenerate matrix.
+        :param min_samples: the minimum number of control points in each zone, at least 3
+        :param cache: as in CorrectionZone
+        """
+        assert min_samples >= 3, 'each zone needs at least 3 control points to be fit'
+        self.min_samples = min_samples
+        self.layout = 'kd' + str(min_samples)
+
+        path = cache_path(self.layout) if cache else None
+        cached = load_cache(path, ('axes', 'thresholds', 'children', 'leaves', 'transformation_matrices', 'depth')) \
+            if path is not None else None
+        if cached is not None:
+            self.axes = cached['axes']
+            self.thresholds = cached['thresholds']
+            self.children = cached['children']
+            self.leaves = cached['leaves']
+            self.transformation_matrices = cached['transformation_matrices']
+            self.depth = int(cached['depth'])
+            print('loaded {0} adaptive zones from {1}'.format(len(self.transformation_matrices), path))
+            return
+
+        self.__fit()
+
+        if path is not None:
+            save_cache(path, axes=self.axes, thresholds=self.thresholds, children=self.children,
+                       leaves=self.leaves, transformation_matrices=self.transformation_matrices,
+                       depth=np.array(self.depth))
+
+    def __fit(self):
+        """
+        builds the tree as flat arrays indexed by node. an internal node compares coordinate axes[n]
+        against thresholds[n] and continues to children[n][0] if the coordinate is <= the threshold,
+        otherwise children[n][1]. a leaf has axes[n] == -1, and leaves[n] indexes its matrix.
+        """
+        source_samples = np.array(load_data('aimsun_samples'))
+        target_samples = np.array(load_data('google_samples'))
+
+        axes, thresholds, children, leaves, matrices, counts = [], [], [], [], [], []
+
+        def build(indices, depth):
+            node = len(axes)
+            axes.append(-1)
+            thresholds.append(0.0)
+            children.append([0, 0])
+            leaves.append(-1)
+
+            points = source_samples[indices]
+            axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+            ordered = indices[np.argsort(points[:, axis], kind='stable')]
+            half = len(ordered) // 2
+            if half >= self.min_samples and len(ordered) - half >= self.min_samples:
+                below = source_samples[ordered[half - 1], axis]
+                above = source_samples[ordered[half], axis]
+                if below < above:
+                    axes[node] = axis
+                    thresholds[node] = (below + above) / 2
+                    left, left_depth = build(ordered[:half], depth + 1)
+                    right, right_depth = build(ordered[half:], depth + 1)
+                    children[node] = [left, right]
+                    return node, max(left_depth, right_depth)
+
+            """ lstsq(P, Q) -> x | Q = Px """
+            source = np.hstack((points, np.ones((len(points), 1))))
+            leaves[node] = len(matrices)
+            matrices.append(np.linalg.lstsq(source, target_samples[indices], rcond=None)[0])
+            counts.append(len(indices))
+            return node, depth
+
+        _, self.depth = build(np.arange(len(source_samples)), 0)
+        self.axes = np.array(axes, dtype=np.intp)
+        self.thresholds = np.array(thresholds, dtype=float)
+        self.children = np.array(children, dtype=np.intp)
+        self.leaves = np.array(leaves, dtype=np.intp)
+        self.transformation_matrices = np.array(matrices, dtype=float)
+
+        print('partitioned {0} control points into {1} adaptive zones with at least {2} points each, tree depth {3}.'
+              .format(len(source_samples), len(matrices), self.min_samples, self.depth))
+        print('# of control points per zone.')
+        print(counts)
+
+    def zone_indices(self, points):
+        """
+        descends the tree for every point at once, one level per step.
+        :param points: an (N, 2) array of [lon, lat] rows
+        :return: an integer array of length N, the index of each point's zone
+        """
+        points = np.asarray(points, dtype=float)
+        nodes = np.zeros(len(points), dtype=np.intp)
+        for _ in range(self.depth):
+            internal = np.nonzero(self.axes[nodes] >= 0)[0]
+            if len(internal) == 0:
+                break
+            at = nodes[internal]
+            right = points[internal, self.axes[at]] > self.thresholds[at]
+            nodes[internal] = self.children[at, right.astype(np.intp)]
+        return self.leaves[nodes]
+
+    def correct_points(self, points):
+        """
+        corrects many points at once, applying each point's zone matrix elementwise, see affine_rows.
+        :param points: an (N, 2) array of [lon, lat] rows
+        :return: an (N, 2) float array of corrected [lon, lat] rows
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return affine_rows(points, self.transformation_matrices[self.zone_indices(points)])
+
+    def correct_point(self, p, formatted):
+        transformed = self.correct_points([(p['longitude'], p['latitude'])])[0].tolist()
+        to_return = {'longitude': transformed[0], 'latitude': transformed[1]}
+        if formatted:
+            to_return = format_coordinate(to_return)
+        return to_return
+
+
 def format_coordinate(coord):
     """
     Formats the longitude and latitude to fit TMDD Standards.
@@ -131,44 +388,484 @@ def format_coordinate(coord):
             'latitude': int(round(coord['latitude'] * 10 ** DIGIT_PRECISION))}
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-horizontal", type=int,
-                    help="the number of horizontal zones")
-parser.add_argument("-vertical", type=int,
-                    help="the number of vertical zones")
-args = parser.parse_args()
-
-assert args.horizontal and args.vertical, "-horizontal, -vertical are required. example usage: \'py correct_distortion.py -horizontal 2 -vertical 1\'"
-
-cz = CorrectionZone(args.horizontal, args.vertical)
+def format_coordinates(points):
+    """
+    Vectorized format_coordinate. Formats an (N, 2) array of [lon, lat] rows to TMDD integers.
+    """
+    return np.round(np.asarray(points) * 10 ** DIGIT_PRECISION).astype(np.int64)
 
-unprocessed_json = io.get_JSON_strings()
 
-for key in filter(lambda name: 'corrected' not in name, unprocessed_json.keys()):
-    print('Correcting', key)
-    tmdd_object_system = json.loads(unprocessed_json[key])
+def correct_network(cz, tmdd_object_system, formatted):
+    """
+    Corrects every coordinate in a tmdd network in place. All coordinates are gathered into a
+    single array, corrected with CorrectionZone.correct_points, and written back.
 
-    """ 
-    transform and update each coordinate in the tmdd network.
-    
     fields to transform:
     LinkInventory -> link-inventory-list -> link-begin-node-location -> p
                                          -> link-end-node-location -> p
                                          -> link-geom-location -> [p1, ..., pn]
-    
+
     NodeInventory -> node-inventory-list -> node-location -> p
-    
+
+    :param cz: a fitted CorrectionZone
+    :param tmdd_object_system: a parsed tmdd document
+    :param formatted: if true, coordinates are written as TMDD integers
     """
-    link_inventory = tmdd_object_system['LinkInventory']['link-inventory-list']
-    node_inventory = tmdd_object_system['NodeInventory']['node-inventory-list']
+    correct_records(cz,
+                    tmdd_object_system['LinkInventory']['link-inventory-list'],
+                    tmdd_object_system['NodeInventory']['node-inventory-list'],
+                    formatted)
+    return tmdd_object_system
 
-    for link in link_inventory:
-        link['link-begin-node-location'] = cz.correct_point(link['link-begin-node-location'], FORMAT)
-        link['link-end-node-location'] = cz.correct_point(link['link-end-node-location'], FORMAT)
-        link['link-geom-location'] = [cz.correct_point(p, FORMAT) for p in link['link-geom-location']]
 
+def correct_records(cz, link_inventory, node_inventory, formatted):
+    """
+    Corrects the coordinates of lists of link and node inventory records in place.
+    """
+    """ the location of each coordinate, as (container, key) pairs, in the same order as coordinates. """
+    slots = []
+    for link in link_inventory:
+        slots.append((link, 'link-begin-node-location'))
+        slots.append((link, 'link-end-node-location'))
+        geometry = link['link-geom-location']
+        slots.extend((geometry, k) for k in range(len(geometry)))
     for node in node_inventory:
-        node['node-location'] = cz.correct_point(node['node-location'], FORMAT)
+        slots.append((node, 'node-location'))
+
+    if not slots:
+        return
+
+    with profiling.stage('correct', hot=True, links=len(link_inventory), nodes=len(node_inventory),
+                         coordinates=len(slots)):
+        coordinates = np.array([(c[k]['longitude'], c[k]['latitude']) for c, k in slots], dtype=float)
+        corrected = cz.correct_points(coordinates)
+        corrected = format_coordinates(corrected).tolist() if formatted else corrected.tolist()
+
+        for (container, key), (lon, lat) in zip(slots, corrected):
+            container[key] = {'longitude': lon, 'latitude': lat}
 
+
+def correct_stream(cz, fields, formatted, batch_size=BATCH_SIZE):
+    """
+    Corrects (section, key, value) triples as yielded by local_io.iter_tmdd. Link and node inventory
+    records are corrected batch_size at a time, so memory is bounded by the batch, not the network.
+    """
+    def corrected_batches(key, records):
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            if key == 'link-inventory-list':
+                correct_records(cz, batch, [], formatted)
+            else:
+                correct_records(cz, [], batch, formatted)
+            yield from batch
+
+    for section, key, value in fields:
+        if key in ('link-inventory-list', 'node-inventory-list') and hasattr(value, '__next__'):
+            value = corrected_batches(key, value)
+        yield section, key, value
+
+
+def corrected_name(cz, key):
+    return key + '_corrected_' + cz.layout
+
+
+def correct_arrays(cz, arrays, formatted):
+    """
+    Corrects (n, 2) coordinate arrays together, in one call to correct_points.
+    :return: the corrected arrays, in the same order
+    """
+    coordinates = np.concatenate([np.asarray(array, dtype=float).reshape(-1, 2) for array in arrays])
+    corrected = cz.correct_points(coordinates)
+    corrected = format_coordinates(corrected) if formatted else corrected
+    return np.split(corrected, np.cumsum([len(array) for array in arrays])[:-1])
+
+
+def correct_columns(cz, columns, formatted):
+    """
+    Corrects every coordinate array of a NetworkColumns, replacing the (possibly memory mapped) arrays.
+    """
+    names = ('link_coordinates', 'link_begin', 'link_end', 'node_location')
+    with profiling.stage('correct', hot=True, links=columns.link_count, nodes=columns.node_count) as counts:
+        corrected = correct_arrays(cz, [columns.arrays[name] for name in names], formatted)
+        counts['coordinates'] = sum(len(array) for array in corrected)
+        columns.arrays.update(zip(names, corrected))
+    return columns
+
+
+def correct_model(cz, network, formatted):
+    """
+    Corrects every coordinate array of a network.Network in place. Formatted coordinates are kept as int32.
+    """
+    names = ('link_coordinates', 'link_begin', 'link_end', 'node_locations')
+    with profiling.stage('correct', hot=True, links=len(network.links), nodes=len(network.nodes)) as counts:
+        corrected = correct_arrays(cz, [getattr(network, name) for name in names], formatted)
+        counts['coordinates'] = sum(len(array) for array in corrected)
+        for name, array in zip(names, corrected):
+            setattr(network, name, compact_coordinates(array))
+    return network
+
+
+INCREMENTAL_SECTIONS = (('LinkInventory', 'link-inventory-list', 'link-id',
+                         ('link-begin-node-location', 'link-end-node-location', 'link-geom-location')),
+                        ('NodeInventory', 'node-inventory-list', 'node-id', ('node-location',)))
+# (section, list key, id key, location fields) of the records -incremental corrects
+
+
+def set_locations(record, fields, values):
+    """
+    the inverse of incremental.location_values: sets a record's location fields from one flat list of
+    longitudes and latitudes, taking as many points for a list as the record already holds.
+    """
+    points = iter(zip(values[0::2], values[1::2]))
+    for field in fields:
+        if isinstance(record[field], dict):
+            lon, lat = next(points)
+            record[field] = {'longitude': lon, 'latitude': lat}
+        else:
+            record[field] = [{'longitude': lon, 'latitude': lat}
+                             for lon, lat in itertools.islice(points, len(record[field]))]
+
+
+def correct_incremental(cz, tmdd_object_system, path, name, formatted, output=None):
+    """
+    Corrects only the links and nodes that were added or modified since the network was last corrected into
+    name.json. Unchanged elements reuse their corrected coordinates, which the manifest keeps alongside the
+    hash of each element, so the previous output is never read. Writes name_delta.json holding only the
+    changed elements, and, unless nothing changed, name.json and the manifest that the next run compares against.
+    :param output: keyword arguments for local_io.write_tmdd_json
+    :return: the changes, as returned by incremental.diff_manifests
+    """
+    output = output or {}
+    manifest_path = path + io.separator() + name + MANIFEST_EXTENSION
+    with profiling.stage('hash', links=len(tmdd_object_system['LinkInventory']['link-inventory-list'])):
+        manifest = incremental.build_manifest(tmdd_object_system, formatted=formatted,
+                                              zones=os.path.basename(cache_path(cz.layout)))
+
+    previous = incremental.read_manifest(manifest_path)
+    if previous is not None and (not os.path.isfile(io.tmdd_path(path, name, output.get('compress', False))) or
+                                 'coordinates' not in previous):
+        previous = None
+    changes = incremental.diff_manifests(previous, manifest)
+
+    if previous is not None and not any(keys for change in changes.values() for keys in change.values()):
+        """ name.json and the manifest are already up to date. """
+        io.write_tmdd_json(incremental.build_delta(tmdd_object_system, changes), path, name + io.DELTA_SUFFIX,
+                           **output)
+        return changes
+
+    pending = {}
+    keys = {}
+    manifest['coordinates'] = {}
+    for section, list_key, id_key, fields in INCREMENTAL_SECTIONS:
+        changed = incremental.changed_keys(changes, section)
+        corrected = previous['coordinates'][section] if previous is not None else {}
+        coordinates = manifest['coordinates'][section] = {}
+
+        pending[section] = []
+        keys[section] = []
+        records = tmdd_object_system[section][list_key]
+        for key, record in zip(incremental.record_keys(records, id_key), records):
+            if key in changed or key not in corrected:
+                pending[section].append(record)
+                keys[section].append(key)
+            else:
+                set_locations(record, fields, corrected[key])
+                coordinates[key] = corrected[key]
+
+    correct_records(cz, pending['LinkInventory'], pending['NodeInventory'], formatted)
+
+    for section, _, _, fields in INCREMENTAL_SECTIONS:
+        coordinates = manifest['coordinates'][section]
+        for key, record in zip(keys[section], pending[section]):
+            coordinates[key] = [v for field in fields for v in incremental.location_values(record[field])]
+
+    io.write_tmdd_json(tmdd_object_system, path, name, **output)
+    io.write_tmdd_json(incremental.build_delta(tmdd_object_system, changes), path, name + io.DELTA_SUFFIX, **output)
+    incremental.write_manifest(manifest, manifest_path)
+    return changes
+
+
+def correct_file(cz, file, stream=False, update=False, compact=False, output=None, tolerance=None):
+    """
+    Corrects one network in the data directory and writes the corrected network next to it, in the same format.
+    :param cz: a fitted CorrectionZone or AdaptiveCorrectionZone
+    :param file: the .json file or columnar directory name, relative to the data directory
+    :param stream: if true, a .json file is corrected record by record
+    :param update: if true, a .json file is corrected incrementally, see correct_incremental
+    :param compact: if true, a .json file is parsed into a network.Network rather than nested dictionaries
+    :param output: keyword arguments for local_io.write_tmdd_json, e.g. compact=True, compress=True
+    :param tolerance: if given, link geometry is simplified to within this many metres before it is corrected,
+    see simplify.py
+    :return: the file name without the extension, and the number of seconds taken
+    """
+    start = time.perf_counter()
+    output = output or {}
+    key = io.network_name(file)
+    path = io.get_script_path('data')
+    print('Correcting', key)
+
+    with profiling.network(key):
+        if file.endswith(COLUMNAR_EXTENSION):
+            with profiling.stage('read_columns'):
+                columns = NetworkColumns.read(path, file)
+            if tolerance is not None:
+                simplify.report(key, *simplify.simplify_columns(columns, tolerance))
+            correct_columns(cz, columns, FORMAT)
+            with profiling.stage('write_columns'):
+                columns.write(path, corrected_name(cz, key))
+        elif stream:
+            fields = io.iter_tmdd(path + io.separator() + file)
+            totals = {}
+            if tolerance is not None:
+                fields = simplify.simplify_stream(fields, tolerance, totals)
+            io.write_tmdd_stream(correct_stream(cz, fields, FORMAT), path, corrected_name(cz, key), **output)
+            if tolerance is not None:
+                simplify.report(key, totals.get('before', 0), totals.get('after', 0))
+        elif compact:
+            with profiling.stage('build_network'):
+                network = Network.from_stream(io.iter_tmdd(path + io.separator() + file))
+            if tolerance is not None:
+                simplify.report(key, *simplify.simplify_model(network, tolerance))
+            correct_model(cz, network, FORMAT)
+            io.write_tmdd_stream(network.iter_fields(), path, corrected_name(cz, key), **output)
+        else:
+            tmdd_json = io.read_file(file)
+            with profiling.stage('json.loads'):
+                tmdd_object_system = json.loads(tmdd_json)
+            del tmdd_json
+
+            if tolerance is not None:
+                simplify.report(key, *simplify.simplify_records(
+                    tmdd_object_system['LinkInventory']['link-inventory-list'], tolerance))
+
+            if update:
+                changes = correct_incremental(cz, tmdd_object_system, path, corrected_name(cz, key), FORMAT,
+                                              output)
+                print(key, incremental.summarize(changes))
+            else:
+                """ transform and update each coordinate in the tmdd network. """
+                correct_network(cz, tmdd_object_system, FORMAT)
+
+                io.write_tmdd_json(tmdd_object_system, path, corrected_name(cz, key), **output)
+
+    return key, time.perf_counter() - start
+
+
+""" the CorrectionZone fitted by the parent process, shared with each pool worker once at startup. """
+_worker_zone = None
+
+
+def _init_worker(cz, profile, cprofile_path, trace_memory):
+    global _worker_zone
+    _worker_zone = cz
+    if profile:
+        profiling.enable(profiling.worker_cprofile_path(cprofile_path), trace_memory)
+
+
+def _correct_file_worker(task):
+    return correct_file(_worker_zone, *task), profiling.PROFILER.drain()
+
+
+def correct_files(cz, files, stream=False, jobs=1, update=False, compact=False, output=None, tolerance=None):
+    """
+    Corrects each file, spreading them across a pool of jobs processes if jobs > 1. The fitted
+    CorrectionZone is sent to each worker once rather than refit.
+    :return: a list of (file name without the extension, seconds) in the order files finished
+    """
+    if jobs > 1 and len(files) > 1:
+        results = []
+        initargs = (cz, profiling.PROFILER.enabled, profiling.PROFILER.cprofile_path, profiling.PROFILER.trace_memory)
+        tasks = [(file, stream, update, compact, output, tolerance) for file in files]
+        with multiprocessing.Pool(min(jobs, len(files)), initializer=_init_worker, initargs=initargs) as pool:
+            for result, records in pool.imap_unordered(_correct_file_worker, tasks):
+                profiling.PROFILER.merge(records)
+                results.append(result)
+        return results
+    return [correct_file(cz, file, stream, update, compact, output, tolerance) for file in files]
+
+
+def uncorrected_files(columnar=False):
+    """ the networks in the data directory that are not themselves corrected output. """
+    files = get_columnar_files() if columnar else io.get_JSON_files()
+    return [file for file in files if 'corrected' not in file]
+
+
+def corrected_file(cz, file, output=None):
+    """ the name, relative to the data directory, of the file correct_file writes for file. """
+    name = corrected_name(cz, io.network_name(file))
+    if file.endswith(COLUMNAR_EXTENSION):
+        return name + COLUMNAR_EXTENSION
+    return name + '.json' + (io.GZIP_EXTENSION if (output or {}).get('compress') else '')
+
+
+def file_signature(filepath):
+    """
+    the modification time and size of a file, or None if it does not exist. a directory, such as a columnar
+    network whose arrays are rewritten in place, is signed by the newest modification time and the total
+    size of the files in it.
+    """
+    try:
+        status = os.stat(filepath)
+        if not os.path.isdir(filepath):
+            return status.st_mtime_ns, status.st_size
+        with os.scandir(filepath) as entries:
+            files = [entry.stat() for entry in entries if entry.is_file()]
+    except OSError:
+        return None
+    return max([status.st_mtime_ns] + [f.st_mtime_ns for f in files]), sum(f.st_size for f in files)
+
+
+def watch(fit, columnar=False, stream=False, update=False, compact=False, output=None, interval=WATCH_INTERVAL,
+          tolerance=None):
+    """
+    Corrects and exports each new or modified network in the data directory as it appears, until interrupted.
+    The fitted zone is kept between files, and refit only when a sample file changes. A file is only
+    picked up once its size and modification time have not changed for a whole interval, so networks
+    still being written are left alone, and the same goes for the sample files before a refit. If the
+    refit fails, the previous zone is kept until the sample files change again. Networks whose corrected
+    output is newer than both the network and the sample files are skipped.
+    :param fit: returns a newly fitted CorrectionZone or AdaptiveCorrectionZone
+    :param stream, update, compact, output, tolerance: as correct_file
+    """
     path = io.get_script_path('data')
-    io.write_tmdd_json(tmdd_object_system, path, key + '_corrected_' + str(cz.horizontal_zones) + 'x' + str(cz.vertical_zones))
+    cz = fit()
+    """ the sample files the zone was fit from, the last ones handled, and the ones waiting to settle. """
+    fitted = samples = [file_signature(sample) for sample in SAMPLE_FILES]
+    pending_samples = None
+    done = {}
+    pending = {}
+    print('watching {0} for new networks every {1}s. interrupt to stop.'.format(path, interval))
+
+    try:
+        while True:
+            current = [file_signature(sample) for sample in SAMPLE_FILES]
+            if current != samples and current == pending_samples:
+                print('control points changed, refitting.')
+                samples = current
+                try:
+                    with profiling.stage('fit_zones'):
+                        cz = fit()
+                    fitted = current
+                    done = {}
+                except Exception as error:
+                    """ e.g. a sample row still being written. it is refit once the samples change again. """
+                    print('  refitting failed, keeping the previous zones. {0!r}'.format(error))
+            elif current != samples:
+                pending_samples = current
+
+            ready = []
+            for file in uncorrected_files(columnar):
+                signature = file_signature(path + io.separator() + file)
+                if signature is None or done.get(file) == signature:
+                    continue
+                output_signature = file_signature(path + io.separator() + corrected_file(cz, file, output))
+                newest_input = max([signature[0]] + [sample[0] for sample in fitted if sample])
+                if output_signature is not None and output_signature[0] >= newest_input:
+                    done[file] = signature
+                elif pending.get(file) == signature:
+                    ready.append(file)
+                else:
+                    pending[file] = signature
+
+            for file in ready:
+                done[file] = pending.pop(file)
+                try:
+                    key, seconds = correct_file(cz, file, stream, update, compact, output, tolerance)
+                    export.export_file(corrected_file(cz, file, output))
+                    print('  {0}: corrected in {1:.2f}s'.format(key, seconds))
+                except Exception as error:
+                    """ a bad network must not stop the watch. it is retried once it is modified again. """
+                    print('  {0}: failed, {1!r}'.format(file, error))
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print('stopped watching.')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-horizontal", type=int,
+                        help="the number of horizontal zones")
+    parser.add_argument("-vertical", type=int,
+                        help="the number of vertical zones")
+    parser.add_argument("-adaptive", type=int,
+                        help="partition adaptively with a k-d tree instead, with at least this many control points per zone")
+    parser.add_argument("-stream", action="store_true",
+                        help="parse and correct each network record by record, in bounded memory")
+    parser.add_argument("-compact", action="store_true",
+                        help="hold each network as compact link and node objects over shared coordinate arrays")
+    parser.add_argument("-minify", action="store_true",
+                        help="write the corrected .json without indentation")
+    parser.add_argument("-gzip", action="store_true",
+                        help="write the corrected .json gzip compressed, as .json.gz")
+    parser.add_argument("-fast-json", action="store_true",
+                        help="encode the corrected .json with orjson, if it is installed")
+    parser.add_argument("-jobs", "--jobs", type=int, default=1,
+                        help="the number of files to correct in parallel")
+    parser.add_argument("-no-cache", action="store_true",
+                        help="refit the zones instead of reusing fitted zones from the cache")
+    parser.add_argument("-columnar", action="store_true",
+                        help="correct the columnar networks in the data directory instead of the .json files")
+    parser.add_argument("-simplify", type=float, metavar='METRES',
+                        help="drop link geometry vertices within METRES of the simplified line before correcting. "
+                             "the first and last vertex of each link are always kept")
+    parser.add_argument("-incremental", action="store_true",
+                        help="only correct the links and nodes that changed since the last -incremental run, "
+                             "and write a delta document of them")
+    parser.add_argument("-watch", nargs='?', type=float, const=WATCH_INTERVAL, metavar='SECONDS',
+                        help="keep running, correcting and exporting each new or modified network as it appears, "
+                             "and refitting when the sample files change. polls every SECONDS")
+    parser.add_argument("-profile", "--profile", nargs='?', const='', metavar='REPORT',
+                        help="print the time, peak resident memory and item counts of each stage of each file, "
+                             "and write them to REPORT as json if given")
+    parser.add_argument("-cprofile", metavar='PATH',
+                        help="capture the correction loop with cProfile and write the stats to PATH (implies -profile)")
+    parser.add_argument("-trace-memory", action="store_true",
+                        help="also trace allocations to record the peak memory of each stage (implies -profile). "
+                             "slows the run, some stages far more than others")
+    args = parser.parse_args()
+
+    assert args.adaptive or (args.horizontal and args.vertical), "-horizontal, -vertical (or -adaptive) are required. example usage: \'py correct_distortion.py -horizontal 2 -vertical 1\'"
+
+    assert not (args.incremental and (args.stream or args.columnar)), "-incremental cannot be combined with -stream or -columnar."
+
+    assert not (args.incremental and args.simplify is not None), "-simplify cannot be combined with -incremental."
+
+    assert args.simplify is None or args.simplify >= 0, "-simplify must not be negative."
+
+    assert not (args.compact and (args.stream or args.columnar or args.incremental)), "-compact cannot be combined with -stream, -columnar or -incremental."
+
+    if args.profile is not None or args.cprofile or args.trace_memory:
+        profiling.enable(args.cprofile, args.trace_memory)
+
+    def fit():
+        if args.adaptive:
+            return AdaptiveCorrectionZone(args.adaptive, cache=not args.no_cache)
+        return CorrectionZone(args.horizontal, args.vertical, cache=not args.no_cache)
+
+    output = {'compact': args.minify, 'compress': args.gzip, 'fast': args.fast_json}
+    if args.watch is not None:
+        watch(fit, args.columnar, args.stream, args.incremental, args.compact, output, args.watch, args.simplify)
+        if profiling.PROFILER.enabled:
+            profiling.PROFILER.finish(args.profile)
+        return
+
+    with profiling.stage('fit_zones'):
+        cz = fit()
+
+    start = time.perf_counter()
+    files = uncorrected_files(args.columnar)
+    results = correct_files(cz, files, args.stream, args.jobs, args.incremental, args.compact, output, args.simplify)
+
+    print('corrected {0} files in {1:.2f}s using {2} jobs'.format(len(results), time.perf_counter() - start, args.jobs))
+    for key, seconds in sorted(results):
+        print('  {0}: {1:.2f}s'.format(key, seconds))
+
+    if profiling.PROFILER.enabled:
+        profiling.PROFILER.finish(args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,285 @@
-import json
+import argparse
+import itertools
+import multiprocessing
+import time
+
+import numpy as np
+
 import local_io as io
-from shapely.geometry.point import Point 
-from shapely.geometry.linestring import LineString
+import profiling
+import simplify
+import spatial_index
+from columnar import COLUMNAR_EXTENSION, NetworkColumns, get_columnar_files
+from network import Network
 
 """ extracts the coordinates of each corrected .json file in the ~/tmdd_network/data/ directory. """
 
-data_files = io.get_JSON_strings()
+HEADER = ['source', 'target', 'edge', 'id']
+BATCH_SIZE = 10000
+# number of links encoded together
+
+""" little-endian WKB records, laid out exactly as shapely's wkb_hex writes a Point and a two-point LineString. """
+POINT_WKB = np.dtype([('order', 'u1'), ('type', '<u4'), ('coordinates', '<f8', (2,))])
+SEGMENT_WKB = np.dtype([('order', 'u1'), ('type', '<u4'), ('count', '<u4'), ('coordinates', '<f8', (2, 2))])
+
+
+def to_hex(records):
+    """
+    hex encodes each record of a structured array, returning a list of upper case strings.
+    """
+    width = 2 * records.dtype.itemsize
+    encoded = records.tobytes().hex().upper()
+    return [encoded[i:i + width] for i in range(0, len(encoded), width)]
+
+
+def point_wkb_hex(points):
+    """
+    :param points: an (N, 2) array of [lon, lat] rows
+    :return: a list of N WKB hex strings, identical to Point(lon, lat).wkb_hex
+    """
+    records = np.empty(len(points), dtype=POINT_WKB)
+    records['order'] = 1
+    records['type'] = 1
+    records['coordinates'] = points
+    return to_hex(records)
+
+
+def segment_wkb_hex(sources, targets):
+    """
+    :param sources: an (N, 2) array of [lon, lat] rows
+    :param targets: an (N, 2) array of [lon, lat] rows
+    :return: a list of N WKB hex strings, identical to LineString((source, target)).wkb_hex
+    """
+    records = np.empty(len(sources), dtype=SEGMENT_WKB)
+    records['order'] = 1
+    records['type'] = 2
+    records['count'] = 2
+    records['coordinates'][:, 0] = sources
+    records['coordinates'][:, 1] = targets
+    return to_hex(records)
+
+
+def link_segments(links):
+    """
+    splits the geometry of each link into segments between consecutive vertices.
+    :param links: a list of link inventory records
+    :return: an (S, 2) array of segment sources, an (S, 2) array of segment targets, and an array
+    of length S holding the position in links of each segment's link
+    """
+    counts = np.array([len(link['link-geom-location']) for link in links], dtype=np.intp)
+    coordinates = np.array([(p['longitude'], p['latitude']) for link in links for p in link['link-geom-location']],
+                           dtype=float).reshape(-1, 2)
+
+    return geometry_segments(coordinates, counts)
+
+
+def geometry_segments(coordinates, counts):
+    """
+    :param coordinates: a (V, 2) array of the vertices of consecutive links
+    :param counts: the number of vertices of each link
+    :return: as link_segments
+    """
+    """ every vertex but the last of its link starts a segment. """
+    is_source = np.ones(len(coordinates), dtype=bool)
+    is_source[np.cumsum(counts)[counts > 0] - 1] = False
+    source_index = np.nonzero(is_source)[0]
+
+    link_index = np.repeat(np.arange(len(counts)), np.maximum(counts - 1, 0))
+    return coordinates[source_index], coordinates[source_index + 1], link_index
+
+
+def segment_rows(link_inventory, batch_size=BATCH_SIZE):
+    """
+    yields a (source, target, edge, id) row for each segment of each link. id is a fake id, enumerating
+    the total number of links. links are encoded batch_size at a time.
+    """
+    offset = 0
+    while True:
+        links = list(itertools.islice(link_inventory, batch_size))
+        if not links:
+            return
+        yield from encode_rows(*link_segments(links), offset)
+        offset += len(links)
+
+
+def column_segment_rows(columns, batch_size=BATCH_SIZE):
+    """
+    as segment_rows, for a NetworkColumns. vertices are read from its arrays batch_size links at a time.
+    """
+    return offset_segment_rows(columns.arrays['link_coordinates'], columns.arrays['link_offsets'], batch_size)
+
+
+def network_segment_rows(network, batch_size=BATCH_SIZE):
+    """
+    as segment_rows, for a network.Network.
+    """
+    return offset_segment_rows(network.link_coordinates, network.link_offsets, batch_size)
+
+
+def offset_segment_rows(link_coordinates, link_offsets, batch_size=BATCH_SIZE):
+    """
+    as segment_rows, for the vertices of every link in one array. link i's vertices are
+    link_coordinates[link_offsets[i]:link_offsets[i + 1]].
+    """
+    offsets = np.asarray(link_offsets)
+    link_count = len(offsets) - 1
+    for first in range(0, link_count, batch_size):
+        last = min(first + batch_size, link_count)
+        coordinates = np.asarray(link_coordinates[offsets[first]:offsets[last]], dtype=float)
+        yield from encode_rows(*geometry_segments(coordinates, np.diff(offsets[first:last + 1])), first)
+
+
+def encode_rows(sources, targets, link_index, offset):
+    return zip(point_wkb_hex(sources), point_wkb_hex(targets), segment_wkb_hex(sources, targets),
+               (link_index + offset).tolist())
 
-for key in filter(lambda name: 'corrected' in name, data_files.keys()):
+
+def column_link_ids(columns):
+    """ the link-id of each link of a NetworkColumns, or None if not every link has one. """
+    fields = columns.header['link']['columns']
+    return columns.arrays['link_{0}'.format(fields.index(['link-id']))] if ['link-id'] in fields else None
+
+
+def export_tiles(link_coordinates, link_offsets, link_ids, filename):
+    """
+    Writes the spatial_index.SpatialIndex of a network's links as <filename>.index.npz, and the rows of the
+    network's .csv split by tile into <filename>.tiles/<column>_<row>.csv. a segment crossing tiles is
+    written to each.
+    :return: the number of tiles written
+    """
+    path = io.get_script_path('data')
+    with profiling.stage('build_index') as counts:
+        index = spatial_index.SpatialIndex.build(link_coordinates, link_offsets, link_ids)
+        index.write(path, filename)
+        counts['links'] = index.link_count
+
+    with profiling.stage('export_tiles', hot=True, segments=0) as counts:
+        spatial_index.make_tiles_directory(path, filename)
+        sources, targets, link_index = spatial_index.link_segments(index, np.arange(index.link_count))
+        tiles = spatial_index.tile_segment_rows(index, sources, targets, link_index)
+        for tile, segments in sorted(tiles.items()):
+            counts['segments'] += io.export_stream(
+                HEADER, encode_rows(sources[segments], targets[segments], link_index[segments], 0),
+                spatial_index.tile_name(filename, tile))
+        counts['tiles'] = len(tiles)
+    return len(tiles)
+
+
+def export_file(file, tiles=False, tolerance=None):
+    """
+    Writes the .csv for visualising one corrected network in the data directory.
+    :param file: the .json file or columnar directory name, relative to the data directory
+    :param tiles: also write the network's spatial index and tiled .csv files, see export_tiles
+    :param tolerance: if given, link geometry is simplified to within this many metres first, see simplify.py
+    :return: the file name without the extension, and the number of seconds taken
+    """
+    start = time.perf_counter()
+    key = io.network_name(file)
+    path = io.get_script_path('data')
     print('processing {0}.json'.format(key))
-    tmdd_object_system = json.loads(data_files[key])
-    link_inventory = tmdd_object_system['LinkInventory']['link-inventory-list']
-
-    """ build and write the .csv for visualising the network. id is a fake id, enumerating the
-    total number of links. """
-    data = []
-    for count, link in enumerate(link_inventory):
-        link_points = link['link-geom-location']
-        for source, target in zip(link_points[:-1], link_points[1:]):
-            source_point = Point(source['longitude'], source['latitude'])
-            target_point = Point(target['longitude'], target['latitude'])
-            edge = LineString((source_point, target_point))
-            data.append(
-                {'source': source_point.wkb_hex,
-                 'target': target_point.wkb_hex,
-                 'edge': edge.wkb_hex,
-                 'id': count})
-    io.export(['source', 'target', 'edge', 'id'], data, key)
+
+    with profiling.network(key):
+        if tiles:
+            """ the index needs every link's geometry at once, so the network is held in arrays. """
+            with profiling.stage('build_network'):
+                if file.endswith(COLUMNAR_EXTENSION):
+                    columns = NetworkColumns.read(path, file)
+                    arrays = (columns.arrays['link_coordinates'], columns.arrays['link_offsets'], column_link_ids(columns))
+                else:
+                    network = Network.from_stream(io.iter_tmdd(path + io.separator() + file))
+                    arrays = (network.link_coordinates, network.link_offsets, [link.link_id for link in network.links])
+            if tolerance is not None:
+                coordinates, offsets = simplify.simplify_arrays(arrays[0], arrays[1], tolerance)
+                simplify.report(key, len(arrays[0]), len(coordinates))
+                arrays = (coordinates, offsets, arrays[2])
+            with profiling.stage('export_csv', hot=True) as counts:
+                counts['segments'] = io.export_stream(HEADER, offset_segment_rows(*arrays[:2]), key)
+            export_tiles(*arrays, key)
+            return key, time.perf_counter() - start
+
+        if file.endswith(COLUMNAR_EXTENSION):
+            columns = NetworkColumns.read(path, file)
+            if tolerance is not None:
+                simplify.report(key, *simplify.simplify_columns(columns, tolerance))
+            with profiling.stage('export_csv', hot=True) as counts:
+                counts['segments'] = io.export_stream(HEADER, column_segment_rows(columns), key)
+            return key, time.perf_counter() - start
+
+        """ links are parsed, encoded and written a batch at a time rather than loading the whole document. """
+        totals = {}
+        for section, list_key, link_inventory in io.iter_tmdd(path + io.separator() + file):
+            if list_key == 'link-inventory-list':
+                if tolerance is not None:
+                    link_inventory = simplify.simplify_iter(link_inventory, tolerance, totals, BATCH_SIZE)
+                with profiling.stage('export_csv', hot=True) as counts:
+                    counts['segments'] = io.export_stream(HEADER, segment_rows(link_inventory), key)
+        if tolerance is not None:
+            simplify.report(key, totals.get('before', 0), totals.get('after', 0))
+
+    return key, time.perf_counter() - start
+
+
+def _init_worker(profile, cprofile_path, trace_memory):
+    if profile:
+        profiling.enable(profiling.worker_cprofile_path(cprofile_path), trace_memory)
+
+
+def _export_file_worker(task):
+    return export_file(*task), profiling.PROFILER.drain()
+
+
+def export_files(files, jobs=1, tiles=False, tolerance=None):
+    """
+    Exports each file, spreading them across a pool of jobs processes if jobs > 1.
+    :return: a list of (file name without the extension, seconds) in the order files finished
+    """
+    if jobs > 1 and len(files) > 1:
+        results = []
+        initargs = (profiling.PROFILER.enabled, profiling.PROFILER.cprofile_path, profiling.PROFILER.trace_memory)
+        with multiprocessing.Pool(min(jobs, len(files)), initializer=_init_worker, initargs=initargs) as pool:
+            for result, records in pool.imap_unordered(_export_file_worker, [(file, tiles, tolerance) for file in files]):
+                profiling.PROFILER.merge(records)
+                results.append(result)
+        return results
+    return [export_file(file, tiles, tolerance) for file in files]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-jobs", "--jobs", type=int, default=1,
+                        help="the number of files to export in parallel")
+    parser.add_argument("-columnar", action="store_true",
+                        help="export the columnar networks in the data directory instead of the .json files")
+    parser.add_argument("-tiles", action="store_true",
+                        help="also write a spatial index of each network's links and its .csv split into tiles")
+    parser.add_argument("-simplify", type=float, metavar='METRES',
+                        help="drop link geometry vertices within METRES of the simplified line before exporting. "
+                             "the first and last vertex of each link are always kept")
+    parser.add_argument("-profile", "--profile", nargs='?', const='', metavar='REPORT',
+                        help="print the time, peak resident memory and item counts of each stage of each file, "
+                             "and write them to REPORT as json if given")
+    parser.add_argument("-cprofile", metavar='PATH',
+                        help="capture the export loop with cProfile and write the stats to PATH (implies -profile)")
+    parser.add_argument("-trace-memory", action="store_true",
+                        help="also trace allocations to record the peak memory of each stage (implies -profile). "
+                             "slows the run, some stages far more than others")
+    args = parser.parse_args()
+
+    if args.profile is not None or args.cprofile or args.trace_memory:
+        profiling.enable(args.cprofile, args.trace_memory)
+
+    start = time.perf_counter()
+    files = get_columnar_files() if args.columnar else io.get_JSON_files()
+    files = [file for file in files if 'corrected' in file]
+    results = export_files(files, args.jobs, args.tiles, args.simplify)
+
+    print('exported {0} files in {1:.2f}s using {2} jobs'.format(len(results), time.perf_counter() - start, args.jobs))
+    for key, seconds in sorted(results):
+        print('  {0}: {1:.2f}s'.format(key, seconds))
+
+    if profiling.PROFILER.enabled:
+        profiling.PROFILER.finish(args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+import argparse
+import array
+import heapq
+import json
+import time
+
+import numpy as np
+
+import local_io as io
+import profiling
+from network import MISSING, Network
+
+"""
+the directed graph of a tmdd network's links, for checking its references and routes. run from the
+repository directory to validate every .json network in the data directory.
+
+nodes are numbered in node inventory order, followed by any node-ids links reference but the node
+inventory lacks. the links leaving each node are held in compressed sparse rows: the links leaving node n
+are out_links[out_offsets[n]:out_offsets[n + 1]], and they lead to out_nodes over the same range.
+building the graph and validating every route are linear in the size of the network.
+"""
+
+UNKNOWN_LINK = 'unknown link'
+# the route lists a link-id the link inventory lacks, e.g. a circular or railroad link dropped by the exporter
+DISCONNECTED = 'disconnected'
+# the link does not begin at the node where the route's previous link ends
+EMPTY_ROUTE = 'empty'
+# the route lists no links
+REPORT_LIMIT = 10
+# broken routes and references printed per network
+
+
+class LinkGraph:
+    def __init__(self, node_ids, inventory_nodes, link_ids, link_source, link_target, link_lengths):
+        """
+        Use build, from_network or from_tmdd to make one.
+        :param node_ids: the node-id of each node
+        :param inventory_nodes: the number of nodes from the node inventory, which come first in node_ids
+        :param link_ids: the link-id of each link
+        :param link_source: the begin node of each link, or -1 if the link has none
+        :param link_target: the end node of each link, or -1 if the link has none
+        :param link_lengths: the link-length of each link, nan where missing
+        """
+        self.node_ids = node_ids
+        self.node_index = {node_id: i for i, node_id in enumerate(node_ids)}
+        self.inventory_nodes = inventory_nodes
+        self.link_ids = link_ids
+        self.link_index = {link_id: i for i, link_id in reversed(list(enumerate(link_ids)))}
+        self.link_source = link_source
+        self.link_target = link_target
+        self.link_lengths = link_lengths
+
+        linked = np.nonzero(link_source >= 0)[0]
+        self.out_links = linked[np.argsort(link_source[linked], kind='stable')]
+        self.out_nodes = link_target[self.out_links]
+        self.out_offsets = np.zeros(self.node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(link_source[linked], minlength=self.node_count), out=self.out_offsets[1:])
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @property
+    def link_count(self):
+        return len(self.link_ids)
+
+    @classmethod
+    def build(cls, node_ids, links):
+        """
+        :param node_ids: the node-id of each node of the node inventory
+        :param links: (link-id, begin node-id, end node-id, link-length) of each link. missing values are None.
+        """
+        node_ids = [str(node_id) for node_id in node_ids]
+        index = {}
+        for node_id in node_ids:
+            index.setdefault(node_id, len(index))
+        """ a node-id listed twice is numbered once, where it first appears. """
+        node_ids = list(index)
+        inventory_nodes = len(node_ids)
+
+        def node(node_id):
+            if node_id is None:
+                return -1
+            node_id = str(node_id)
+            if node_id not in index:
+                index[node_id] = len(node_ids)
+                node_ids.append(node_id)
+            return index[node_id]
+
+        link_ids = []
+        source, target, lengths = array.array('q'), array.array('q'), array.array('d')
+        for link_id, begin, end, length in links:
+            link_ids.append(str(link_id))
+            source.append(node(begin))
+            target.append(node(end))
+            lengths.append(length if isinstance(length, (int, float)) else float('nan'))
+
+        return cls(node_ids, inventory_nodes, link_ids, np.array(source, dtype=np.int64),
+                   np.array(target, dtype=np.int64), np.array(lengths, dtype=float))
+
+    @classmethod
+    def from_network(cls, network):
+        """ the graph of a network.Network. """
+        def value(v):
+            return None if v is MISSING else v
+        return cls.build([node.node_id for node in network.nodes],
+                         ((link.link_id, value(link.begin_node_id), value(link.end_node_id), value(link.length))
+                          for link in network.links))
+
+    @classmethod
+    def from_tmdd(cls, tmdd_object):
+        """ the graph of a parsed tmdd document. """
+        links = tmdd_object['LinkInventory']['link-inventory-list']
+        nodes = tmdd_object['NodeInventory']['node-inventory-list']
+        return cls.build([node['node-id'] for node in nodes],
+                         ((link['link-id'], link.get('link-begin-node-id'), link.get('link-end-node-id'),
+                           link.get('link-length')) for link in links))
+
+    def missing_node_references(self):
+        """
+        :return: a list of (link-id, 'begin' or 'end', node-id) for each node a link references that is not
+        in the node inventory. node-id is None if the link has no such node.
+        """
+        missing = []
+        for position, nodes in (('begin', self.link_source), ('end', self.link_target)):
+            for link in np.nonzero(nodes >= self.inventory_nodes)[0].tolist() + np.nonzero(nodes < 0)[0].tolist():
+                missing.append((self.link_ids[link], position, self.node_ids[nodes[link]] if nodes[link] >= 0 else None))
+        return missing
+
+    def route_links(self, route_link_ids):
+        """
+        :param route_link_ids: a list of route-link-id-list
+        :return: the link index of every listed link-id, route after route, -1 for unknown link-ids,
+        and the offsets of each route within them
+        """
+        counts = np.array([len(ids) for ids in route_link_ids], dtype=np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        links = np.fromiter((self.link_index.get(str(link_id), -1) for ids in route_link_ids for link_id in ids),
+                            dtype=np.int64, count=int(offsets[-1]))
+        return links, offsets
+
+    def broken_routes(self, routes):
+        """
+        Checks that each route is a connected chain of links in the link inventory.
+        :param routes: route inventory records
+        :return: a list of {'route-id', 'route-name', 'problem', 'position', 'link-id'} for each problem,
+        where position is the index in route-link-id-list of the link at fault
+        """
+        route_link_ids = [route.get('route-link-id-list') or [] for route in routes]
+        links, offsets = self.route_links(route_link_ids)
+        route_of = np.repeat(np.arange(len(routes)), np.diff(offsets))
+        positions = np.arange(len(links)) - offsets[route_of]
+
+        known = links >= 0
+        """ unknown links, -1, index the -1 appended to each array. """
+        ends = np.append(self.link_target, -1)[links]
+        begins = np.append(self.link_source, -1)[links]
+        """ each link after the first of its route must begin where the one before it ends. """
+        follows = route_of[1:] == route_of[:-1]
+        gap = np.zeros(len(links), dtype=bool)
+        gap[1:] = follows & known[1:] & known[:-1] & ((ends[:-1] != begins[1:]) | (ends[:-1] < 0))
+
+        problems = [(int(r), EMPTY_ROUTE, None) for r in np.nonzero(np.diff(offsets) == 0)[0]]
+        problems += [(int(route_of[i]), UNKNOWN_LINK, i) for i in np.nonzero(~known)[0]]
+        problems += [(int(route_of[i]), DISCONNECTED, i) for i in np.nonzero(gap)[0]]
+        problems.sort(key=lambda p: (p[0], -1 if p[2] is None else p[2]))
+
+        return [{'route-id': routes[r].get('route-id'),
+                 'route-name': routes[r].get('route-name'),
+                 'problem': problem,
+                 'position': None if i is None else int(positions[i]),
+                 'link-id': None if i is None else str(route_link_ids[r][positions[i]])}
+                for r, problem, i in problems]
+
+    def reachable(self, sources, max_links=None):
+        """
+        :param sources: node indices to start from
+        :param max_links: stop after this many links, or None to follow every path
+        :return: a boolean mask of the nodes reachable from any source
+        """
+        seen = np.zeros(self.node_count, dtype=bool)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        seen[frontier] = True
+        steps = 0
+        while len(frontier) and (max_links is None or steps < max_links):
+            starts, ends = self.out_offsets[frontier], self.out_offsets[frontier + 1]
+            counts = ends - starts
+            edges = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            targets = self.out_nodes[edges]
+            targets = np.unique(targets[targets >= 0])
+            frontier = targets[~seen[targets]]
+            seen[frontier] = True
+            steps += 1
+        return seen
+
+    def shortest_path(self, source, target, weights=None):
+        """
+        Dijkstra's algorithm over the links.
+        :param source: node index
+        :param target: node index
+        :param weights: the cost of each link, by default its link-length, or 1 where that is missing
+        :return: the link indices of a cheapest path from source to target, or None if there is none
+        """
+        if weights is None:
+            weights = np.where(np.isnan(self.link_lengths), 1.0, self.link_lengths)
+        out_offsets, out_links, out_nodes = self.out_offsets.tolist(), self.out_links.tolist(), self.out_nodes.tolist()
+        weights = np.asarray(weights, dtype=float).tolist()
+
+        cost = {source: 0.0}
+        previous = {}
+        heap = [(0.0, source)]
+        done = set()
+        while heap:
+            c, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            if node == target:
+                path = []
+                while node != source:
+                    link = previous[node]
+                    path.append(link)
+                    node = self.link_source[link]
+                return path[::-1]
+            done.add(node)
+            for e in range(out_offsets[node], out_offsets[node + 1]):
+                neighbour = out_nodes[e]
+                if neighbour < 0:
+                    continue
+                candidate = c + weights[out_links[e]]
+                if candidate < cost.get(neighbour, float('inf')):
+                    cost[neighbour] = candidate
+                    previous[neighbour] = out_links[e]
+                    heapq.heappush(heap, (candidate, neighbour))
+        return None
+
+
+def validate_network(network):
+    """
+    Checks the node references of every link and every route of a network.Network.
+    :return: a dictionary of the graph's size, the duplicate node-ids, the missing node references as
+    LinkGraph.missing_node_references, and the broken routes as LinkGraph.broken_routes
+    """
+    with profiling.stage('build_graph') as counts:
+        graph = LinkGraph.from_network(network)
+        counts.update(nodes=graph.node_count, links=graph.link_count)
+    routes = network.document.get('RouteInventory', {}).get('route-inventory-list') or []
+
+    with profiling.stage('validate', hot=True) as counts:
+        node_ids = [node.node_id for node in network.nodes]
+        broken = graph.broken_routes(routes)
+        report = {'nodes': graph.inventory_nodes,
+                  'links': graph.link_count,
+                  'routes': len(routes),
+                  'duplicate_node_ids': len(node_ids) - graph.inventory_nodes,
+                  'missing_node_references': graph.missing_node_references(),
+                  'broken_routes': len({problem['route-id'] for problem in broken}),
+                  'route_problems': broken}
+        counts.update(routes=len(routes), problems=len(broken))
+    return report
+
+
+def print_report(key, report):
+    print('{0}: {1} nodes, {2} links, {3} routes'.format(key, report['nodes'], report['links'], report['routes']))
+    if report['duplicate_node_ids']:
+        print('  {0} duplicate node-ids'.format(report['duplicate_node_ids']))
+    missing = report['missing_node_references']
+    print('  {0} link references to nodes missing from the node inventory'.format(len(missing)))
+    for link_id, position, node_id in missing[:REPORT_LIMIT]:
+        print('    link {0} {1} node {2}'.format(link_id, position, node_id))
+    print('  {0} broken routes'.format(report['broken_routes']))
+    for problem in report['route_problems'][:REPORT_LIMIT]:
+        print('    route {0} ({1}): {2} at position {3}, link {4}'.format(
+            problem['route-id'], problem['route-name'], problem['problem'], problem['position'], problem['link-id']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='checks that the links of every .json network in the data '
+                                                 'directory reference known nodes, and that its routes are '
+                                                 'connected chains of known links.')
+    parser.add_argument("-output",
+                        help="also write the reports to this file as json")
+    parser.add_argument("-profile", "--profile", nargs='?', const='', metavar='REPORT',
+                        help="print the time, peak resident memory and item counts of each stage of each file, "
+                             "and write them to REPORT as json if given")
+    parser.add_argument("-trace-memory", action="store_true",
+                        help="also trace allocations to record the peak memory of each stage (implies -profile). "
+                             "slows the run, some stages far more than others")
+    args = parser.parse_args()
+
+    if args.profile is not None or args.trace_memory:
+        profiling.enable(trace_memory=args.trace_memory)
+
+    start = time.perf_counter()
+    reports = {}
+    for file in io.get_JSON_files():
+        key = io.network_name(file)
+        with profiling.network(key):
+            with profiling.stage('build_network'):
+                network = Network.from_stream(io.iter_tmdd(io.get_script_path('data') + io.separator() + file))
+            reports[key] = validate_network(network)
+        print_report(key, reports[key])
+
+    print('validated {0} files in {1:.2f}s'.format(len(reports), time.perf_counter() - start))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+        print('Writing', args.output)
+
+    if profiling.PROFILER.enabled:
+        profiling.PROFILER.finish(args.profile)
+
+
+if __name__ == '__main__':
+    main()
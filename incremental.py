@@ -0,0 +1,137 @@
+import array
+import hashlib
+import json
+import os
+
+"""
+content hash manifests for incremental tmdd exports. a manifest maps each section to the hash of every
+element in it, keyed by the element's id, so a run can tell which elements were added, removed or
+modified since the previous one.
+
+this module is shared with the aimsun exporter, so it must remain python 2 compatible.
+"""
+
+SECTIONS = (('LinkInventory', 'link-inventory-list', 'link-id'),
+            ('LinkStatus', 'link-status-list', 'link-id'),
+            ('NodeInventory', 'node-inventory-list', 'node-id'),
+            ('NodeStatus', 'node-status-list', 'node-id'),
+            ('RouteInventory', 'route-inventory-list', 'route-id'))
+# (section, list key, id key) of each tracked list
+
+IGNORED_FIELDS = ('last-update-time',)
+# fields that change on every export without the element changing
+LOCATION_FIELDS = ('link-begin-node-location', 'link-end-node-location', 'link-geom-location', 'node-location')
+# fields hashed by the bytes of their coordinates, as formatting each float as text would dominate hashing
+
+
+def location_values(value):
+    """ the longitude and latitude of a location, or of every location in a list, as one flat list. """
+    if isinstance(value, dict):
+        return [value['longitude'], value['latitude']]
+    return [v for p in value for v in (p['longitude'], p['latitude'])]
+
+
+def record_hash(record):
+    """
+    hashes every field but IGNORED_FIELDS, in the record's own key order, which is fixed by whoever wrote it.
+    coordinates are hashed as doubles, the other fields as json.
+    """
+    digest = hashlib.sha1()
+    fields = []
+    for key, value in record.items():
+        if key in IGNORED_FIELDS:
+            continue
+        if key in LOCATION_FIELDS:
+            fields.append(key)
+            digest.update(array.array('d', location_values(value)))
+        else:
+            fields.append((key, value))
+    digest.update(json.dumps(fields).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def record_keys(records, id_key):
+    """
+    Returns the manifest key of each record: its id, suffixed with '#n' for the nth repeat of an id.
+    """
+    seen = dict()
+    keys = []
+    for record in records:
+        key = str(record.get(id_key))
+        seen[key] = seen.get(key, 0) + 1
+        keys.append(key if seen[key] == 1 else '{0}#{1}'.format(key, seen[key] - 1))
+    return keys
+
+
+def build_manifest(tmdd_object, **fingerprint):
+    """
+    :param tmdd_object: a parsed tmdd document
+    :param fingerprint: anything else that invalidates the previous run when it changes, e.g. the correction zones
+    """
+    sections = dict()
+    for section, list_key, id_key in SECTIONS:
+        if section in tmdd_object:
+            records = tmdd_object[section][list_key]
+            sections[section] = dict(zip(record_keys(records, id_key), map(record_hash, records)))
+    return {'fingerprint': fingerprint, 'sections': sections}
+
+
+def read_manifest(filepath):
+    """
+    :return: the manifest written at filepath, or None if there is none
+    """
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, filepath):
+    with open(filepath, 'w') as f:
+        json.dump(manifest, f)
+
+
+def diff_manifests(previous, current):
+    """
+    Compares two manifests. If previous is None or was built with a different fingerprint, every element is added.
+    :return: a dictionary mapping section -> {'added': keys, 'removed': keys, 'modified': keys}
+    """
+    if previous is not None and previous['fingerprint'] != current['fingerprint']:
+        previous = None
+
+    changes = dict()
+    for section, hashes in current['sections'].items():
+        old = previous['sections'].get(section, dict()) if previous is not None else dict()
+        changes[section] = {'added': [key for key in hashes if key not in old],
+                            'removed': [key for key in old if key not in hashes],
+                            'modified': [key for key in hashes if key in old and old[key] != hashes[key]]}
+    return changes
+
+
+def changed_keys(changes, section):
+    """ the keys of the added and modified elements of a section. """
+    return set(changes[section]['added']) | set(changes[section]['modified'])
+
+
+def build_delta(tmdd_object, changes):
+    """
+    Builds a tmdd document holding only the added and modified elements of each tracked section. The ids of
+    removed elements are listed under removed-<id key>-list, e.g. removed-link-id-list.
+    """
+    delta = dict()
+    for section, list_key, id_key in SECTIONS:
+        if section not in changes:
+            continue
+        records = tmdd_object[section][list_key]
+        changed = changed_keys(changes, section)
+        delta[section] = dict(tmdd_object[section])
+        delta[section][list_key] = [record for key, record in zip(record_keys(records, id_key), records)
+                                    if key in changed]
+        delta[section]['removed-{0}-list'.format(id_key)] = changes[section]['removed']
+    return delta
+
+
+def summarize(changes):
+    return ', '.join('{0}: {1} added, {2} modified, {3} removed'.format(
+        section, len(changes[section]['added']), len(changes[section]['modified']), len(changes[section]['removed']))
+        for section, _, _ in SECTIONS if section in changes)
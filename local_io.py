@@ -1,8 +1,31 @@
 import csv
+import functools
+import gzip
 import os
 import sys
 import json
 
+import profiling
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional, a faster encoder for the fast json writers
+
+CHUNK_SIZE = 1 << 16
+# characters read at a time by the streaming tmdd reader
+
+STREAMED_LISTS = ('link-inventory-list', 'link-status-list', 'node-inventory-list', 'node-status-list',
+                  'route-inventory-list')
+# tmdd lists that iter_tmdd yields record by record instead of parsing whole
+
+GZIP_EXTENSION = '.gz'
+# networks named e.g. net.json.gz are read and written gzip compressed
+GZIP_LEVEL = 6
+# zlib's default, much faster than gzip's default of 9 for a slightly larger file
+DELTA_SUFFIX = '_delta'
+# names the delta documents written by -incremental and the aimsun exporter, e.g. net_corrected_2x1_delta.json
+
 
 def separator():
     UNIX_ENCODING = '/'
@@ -19,20 +42,160 @@ def get_JSON_files(path='data', absolute=False):
     # path: the path to the directory
     # absolute: whether or not the filePath should be relative, i.e. ~/myFile.file vs. ~/.../myFile.file
     # system_type: 'windows' or 'unix'
-    files = [file for file in os.listdir(get_script_path(path)) if '.json' in file]
+    # delta documents hold only the changed elements of a network, so they are never listed as networks
+    files = [file for file in os.listdir(get_script_path(path)) if '.json' in file and not is_delta(file)]
     return [get_script_path(path) + separator() + file for file in files] if absolute else files
 
 
+def network_name(file):
+    """
+    The file name without the extension, e.g. net for net.json, net.json.gz or net.columns.
+    """
+    if file.endswith(GZIP_EXTENSION):
+        file = file[:-len(GZIP_EXTENSION)]
+    return file.rsplit('.', 1)[0]
+
+
+def is_delta(file):
+    """
+    Whether a file in the data directory is a delta document rather than a network.
+    """
+    return network_name(file).endswith(DELTA_SUFFIX)
+
+
+def open_text(filepath, mode='r'):
+    """ opens a text file, through gzip if it ends with GZIP_EXTENSION. """
+    if filepath.endswith(GZIP_EXTENSION):
+        return gzip.open(filepath, mode + 't', compresslevel=GZIP_LEVEL, encoding='utf-8')
+    return open(filepath, mode, encoding='utf-8')
+
+
 def read_file(s, dir='data'):
-    file = open(os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + dir + separator() + s)
-    return file.read()
+    with profiling.stage('read') as counts:
+        with open_text(os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + dir + separator() + s) as file:
+            contents = file.read()
+        counts['characters'] = len(contents)
+    return contents
 
 
 def get_JSON_strings():
     """
     Maps the file name without the extension to the associated JSON string.
     """
-    return {file.rsplit(".", 1)[0]: read_file(file) for file in get_JSON_files()}
+    return dict(iter_JSON_strings())
+
+
+def iter_JSON_strings(include=None):
+    """
+    Lazily yields (file name without the extension, JSON string) pairs, reading one file at a time.
+    :param include: an optional predicate on the file name; files it rejects are never read
+    """
+    for file in get_JSON_files():
+        name = network_name(file)
+        if include is None or include(name):
+            yield name, read_file(file)
+
+
+class _JSONReader:
+    """
+    Reads JSON values from a file handle through a bounded buffer.
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if chunk:
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+        else:
+            self.eof = True
+
+    def peek(self):
+        """ returns the next non-whitespace character without consuming it, or '' at the end of the file. """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, characters):
+        c = self.peek()
+        if not c or c not in characters:
+            raise ValueError('expected one of {0!r} at {1!r}'.format(characters, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ decodes the next complete JSON value, reading more of the file until it is available. """
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+                """ a value that ends with the buffer may be a truncated number. """
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        """ yields the elements of the JSON array at the current position one at a time. """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_tmdd(filepath, streamed=STREAMED_LISTS, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parses a tmdd .json file in bounded memory. Yields a (section, key, value) triple for
+    each field of each section, e.g. ('LinkInventory', 'organization-information', {...}).
+    For keys in streamed, value is an iterator over the records of the list instead of the parsed list.
+    It must be consumed before advancing to the next triple; anything left unconsumed is skipped.
+    :param filepath: the path to the .json or .json.gz file
+    :param streamed: the list keys to yield record by record
+    :param chunk_size: the number of characters read at a time
+    """
+    with open_text(filepath) as f:
+        reader = _JSONReader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            section = reader.value()
+            reader.expect(':')
+            reader.expect('{')
+            if reader.peek() == '}':
+                reader.pos += 1
+            else:
+                while True:
+                    key = reader.value()
+                    reader.expect(':')
+                    if key in streamed:
+                        records = reader.items()
+                        yield section, key, records
+                        for _ in records:
+                            pass
+                    else:
+                        yield section, key, reader.value()
+                    if reader.expect(',}') == '}':
+                        break
+            if reader.expect(',}') == '}':
+                return
 
 
 def export(header, data, filename):
@@ -57,9 +220,134 @@ def export(header, data, filename):
         for row in data:
             f.writerow(row)
 
-def write_tmdd_json(tmdd_object, path, filename):
-    tmdd_json = json.dumps(tmdd_object, indent=2)
 
-    tmdd_path = path + separator() + filename + '.json'
-    with open (tmdd_path, 'w') as text_file:
-        text_file.write(tmdd_json)
\ No newline at end of file
+def export_stream(header, rows, filename):
+    """
+    Like export, but rows are written as they are consumed from any iterable instead of being held in a list.
+    :param header: A sequence of strings of length k, where each item is a column name
+    :param rows: An iterable of sequences each of length k, ordered as the header.
+    :return: the number of rows written
+    """
+    filepath = get_script_path('data') + separator() + filename + '.csv'
+    with open(filepath, 'w', newline='\n') as csvfile:
+        f = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+
+        f.writerow(header)
+        count = 0
+        for row in rows:
+            f.writerow(row)
+            count += 1
+        return count
+
+def json_encoder(compact=False, fast=False):
+    """
+    Returns a function that encodes a value as json.dumps(value, indent=2) does, or without any whitespace
+    if compact. If fast and orjson is installed, it encodes instead. orjson's output is identical for tmdd
+    networks, except that it spells floats with exponents differently and writes non-ascii characters
+    as utf-8 rather than escaping them.
+    """
+    if fast and orjson is not None:
+        option = 0 if compact else orjson.OPT_INDENT_2
+        return lambda value: orjson.dumps(value, option=option).decode()
+    if compact:
+        return functools.partial(json.dumps, separators=(',', ':'))
+    return functools.partial(json.dumps, indent=2)
+
+
+_LAYOUTS = {
+    False: {'open': '{\n', 'close': '\n  }\n}', 'section': '  {0}: {{\n', 'next_section': '\n  },\n',
+            'field': '    {0}: ', 'next_field': ',\n', 'first_record': '\n      ', 'next_record': ',\n      ',
+            'close_list': '\n    ]', 'field_indent': '    ', 'record_indent': '      '},
+    True: {'open': '{', 'close': '}}', 'section': '{0}:{{', 'next_section': '},',
+           'field': '{0}:', 'next_field': ',', 'first_record': '', 'next_record': ',',
+           'close_list': ']', 'field_indent': '', 'record_indent': ''},
+}
+# the text between the encoded values of a tmdd document, indented as json.dumps(indent=2) or compact
+
+
+class _ChunkWriter:
+    """ joins small writes into chunks of at least CHUNK_SIZE characters, so each reaches the file once. """
+    def __init__(self, f):
+        self.f = f
+        self.parts = []
+        self.length = 0
+        self.written = 0
+
+    def write(self, s):
+        self.parts.append(s)
+        self.length += len(s)
+        if self.length >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.parts))
+        self.written += self.length
+        self.parts = []
+        self.length = 0
+
+
+def tmdd_path(path, filename, compress=False):
+    return path + separator() + filename + '.json' + (GZIP_EXTENSION if compress else '')
+
+
+def write_tmdd_json(tmdd_object, path, filename, compact=False, compress=False, fast=False):
+    """
+    Writes a tmdd document as json.dumps(tmdd_object, indent=2) would, encoding one record at a time
+    straight to the file rather than building the whole string.
+    :param compact: if true, the json is written without whitespace
+    :param compress: if true, the file is gzip compressed and named filename.json.gz
+    :param fast: if true, encodes with orjson when it is installed, see json_encoder
+    """
+    if not all(isinstance(fields, dict) and fields for fields in tmdd_object.values()):
+        """ write_tmdd_stream cannot represent empty sections, so such documents are encoded whole. """
+        with profiling.stage('json.dumps'):
+            tmdd_json = json_encoder(compact, fast)(tmdd_object)
+        with profiling.stage('write', characters=len(tmdd_json)):
+            with open_text(tmdd_path(path, filename, compress), 'w') as text_file:
+                text_file.write(tmdd_json)
+        return
+
+    fields = ((section, key, iter(value) if key in STREAMED_LISTS and isinstance(value, list) else value)
+              for section, section_fields in tmdd_object.items() for key, value in section_fields.items())
+    write_tmdd_stream(fields, path, filename, compact, compress, fast)
+
+
+def _indent(s, prefix):
+    return s.replace('\n', '\n' + prefix) if prefix else s
+
+
+def write_tmdd_stream(fields, path, filename, compact=False, compress=False, fast=False):
+    """
+    Writes (section, key, value) triples, as yielded by iter_tmdd, one record at a time.
+    Iterator values are written as lists. The output is identical to write_tmdd_json on the
+    equivalent document.
+    :param compact, compress, fast: as write_tmdd_json
+    """
+    encode = json_encoder(compact, fast)
+    layout = _LAYOUTS[compact]
+    with profiling.stage('write_stream') as counts, open_text(tmdd_path(path, filename, compress), 'w') as f:
+        text_file = _ChunkWriter(f)
+        current = None
+        for section, key, value in fields:
+            if section != current:
+                text_file.write(layout['open'] if current is None else layout['next_section'])
+                text_file.write(layout['section'].format(json.dumps(section)))
+                current = section
+            else:
+                text_file.write(layout['next_field'])
+            text_file.write(layout['field'].format(json.dumps(key)))
+
+            if not hasattr(value, '__next__'):
+                text_file.write(_indent(encode(value), layout['field_indent']))
+                continue
+
+            text_file.write('[')
+            empty = True
+            for record in value:
+                text_file.write(layout['first_record'] if empty else layout['next_record'])
+                text_file.write(_indent(encode(record), layout['record_indent']))
+                empty = False
+            text_file.write(']' if empty else layout['close_list'])
+        text_file.write('{}' if current is None else layout['close'])
+        text_file.flush()
+        counts['characters'] = text_file.written
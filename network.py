@@ -0,0 +1,252 @@
+import array
+
+import numpy as np
+
+"""
+a compact in-memory model of a tmdd network. links and nodes are __slots__ objects holding their scalar
+fields, and every coordinate lives in a few shared arrays:
+
+    link_coordinates    (V, 2) every link-geom-location vertex, link after link
+    link_offsets        (L + 1,) link i's vertices are link_coordinates[link_offsets[i]:link_offsets[i + 1]]
+    link_begin          (L, 2) link-begin-node-location
+    link_end            (L, 2) link-end-node-location
+    node_locations      (N, 2) node-location
+
+coordinates of a TMDD formatted network are held as int32 fixed-point values, others as float64.
+conversion to and from the tmdd dictionary layout is lossless, including the order of each record's keys.
+"""
+
+
+class _Missing:
+    """ marks a field absent from a record. pickles by reference, so it stays a singleton in pool workers. """
+    def __reduce__(self):
+        return 'MISSING'
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+LINK_FIELDS = (('network-id', 'network_id'),
+               ('network-name', 'network_name'),
+               ('link-id', 'link_id'),
+               ('link-name', 'name'),
+               ('link-type', 'type'),
+               ('link-capacity', 'capacity'),
+               ('link-length', 'length'),
+               ('link-restrictions', 'restrictions'),
+               ('link-geom-location', None),
+               ('link-begin-node-id', 'begin_node_id'),
+               ('link-begin-node-location', None),
+               ('link-end-node-id', 'end_node_id'),
+               ('link-end-node-location', None),
+               ('last-update-time', 'last_update_time'))
+# tmdd key -> Link attribute, in the order the aimsun exporter writes them. locations live in the network's arrays.
+
+NODE_FIELDS = (('network-id', 'network_id'),
+               ('network-name', 'network_name'),
+               ('node-id', 'node_id'),
+               ('node-name', 'name'),
+               ('node-location', None),
+               ('last-update-time', 'last_update_time'))
+# tmdd key -> Node attribute, in the order the aimsun exporter writes them
+
+INVENTORY_LISTS = ('link-inventory-list', 'node-inventory-list')
+# the lists held as Link and Node objects. every other field is kept as parsed
+
+INT32_MAX = np.iinfo(np.int32).max
+DIGIT_PRECISION = 7
+# digits after the decimal point kept by TMDD formatted coordinates
+TMDD_SCALE = 10 ** DIGIT_PRECISION
+# the factor between degrees and TMDD formatted coordinates
+METRES_PER_DEGREE = 111320.0
+# along the equator, or a meridian to within 1%. longitudes are scaled by the cosine of the latitude
+
+
+class _Element:
+    """
+    base of Link and Node. fields the model has no attribute for are kept in extra, and order holds the
+    record's key order only when it differs from the exporter's.
+    """
+    __slots__ = ('index', 'extra', 'order')
+    fields = ()
+
+    @classmethod
+    def from_record(cls, index, record):
+        element = cls()
+        element.index = index
+        known = set()
+        for key, attribute in cls.fields:
+            known.add(key)
+            if attribute is not None:
+                setattr(element, attribute, record.get(key, MISSING))
+        element.extra = {key: value for key, value in record.items() if key not in known} or None
+
+        canonical = [key for key, _ in cls.fields if key in record] + list(element.extra or ())
+        element.order = tuple(record) if list(record) != canonical else None
+        return element
+
+    def to_record(self, locations):
+        """
+        :param locations: maps each location key of the record to its value
+        """
+        values = {}
+        for key, attribute in self.fields:
+            value = locations[key] if attribute is None else getattr(self, attribute)
+            if value is not MISSING:
+                values[key] = value
+        if self.extra:
+            values.update(self.extra)
+        if self.order is None:
+            return values
+        return {key: values[key] for key in self.order}
+
+
+class Link(_Element):
+    __slots__ = tuple(attribute for _, attribute in LINK_FIELDS if attribute is not None)
+    fields = LINK_FIELDS
+
+
+class Node(_Element):
+    __slots__ = tuple(attribute for _, attribute in NODE_FIELDS if attribute is not None)
+    fields = NODE_FIELDS
+
+
+class _PointBuffer:
+    """ accumulates points in a flat array of doubles, noting whether every value was an int. """
+    def __init__(self):
+        self.values = array.array('d')
+        self.integer = True
+
+    def append(self, point):
+        lon, lat = point['longitude'], point['latitude']
+        self.integer = self.integer and type(lon) is int and type(lat) is int
+        self.values.append(lon)
+        self.values.append(lat)
+
+    def to_array(self):
+        points = np.frombuffer(self.values, dtype=float).reshape(-1, 2) if self.values else np.empty((0, 2))
+        return compact_coordinates(points.astype(np.int64) if self.integer and len(points) else points)
+
+
+def compact_coordinates(points):
+    """
+    Returns integer coordinates as int32 when they fit, which TMDD formatted coordinates always do, and
+    float coordinates unchanged.
+    """
+    points = np.asarray(points)
+    if points.dtype.kind == 'i' and (len(points) == 0 or np.abs(points).max() <= INT32_MAX):
+        return points.astype(np.int32)
+    return points
+
+
+def _location(point):
+    lon, lat = point
+    return {'longitude': lon, 'latitude': lat}
+
+
+class Network:
+    def __init__(self):
+        """
+        A tmdd network held as Link and Node objects and shared coordinate arrays. Use from_tmdd or
+        from_stream to build one. document holds the rest of the tmdd document, with None in place of the
+        inventory lists.
+        """
+        self.document = {}
+        self.links = []
+        self.nodes = []
+        self.link_coordinates = np.empty((0, 2))
+        self.link_offsets = np.zeros(1, dtype=np.int64)
+        self.link_begin = np.empty((0, 2))
+        self.link_end = np.empty((0, 2))
+        self.node_locations = np.empty((0, 2))
+
+    @classmethod
+    def from_tmdd(cls, tmdd_object):
+        """
+        Builds a network from a parsed tmdd document.
+        """
+        return cls.from_stream((section, key, iter(value) if key in INVENTORY_LISTS else value)
+                               for section, fields in tmdd_object.items() for key, value in fields.items())
+
+    @classmethod
+    def from_stream(cls, fields):
+        """
+        Builds a network from (section, key, value) triples as yielded by local_io.iter_tmdd, so the full
+        document never needs to be held as dictionaries.
+        """
+        network = cls()
+        geometry, begin, end, locations = _PointBuffer(), _PointBuffer(), _PointBuffer(), _PointBuffer()
+        offsets = array.array('q', [0])
+
+        for section, key, value in fields:
+            network.document.setdefault(section, {})
+            if key == 'link-inventory-list':
+                network.document[section][key] = None
+                for record in value:
+                    network.links.append(Link.from_record(len(network.links), record))
+                    for point in record['link-geom-location']:
+                        geometry.append(point)
+                    offsets.append(offsets[-1] + len(record['link-geom-location']))
+                    begin.append(record['link-begin-node-location'])
+                    end.append(record['link-end-node-location'])
+            elif key == 'node-inventory-list':
+                network.document[section][key] = None
+                for record in value:
+                    network.nodes.append(Node.from_record(len(network.nodes), record))
+                    locations.append(record['node-location'])
+            else:
+                network.document[section][key] = list(value) if hasattr(value, '__next__') else value
+
+        network.link_coordinates = geometry.to_array()
+        network.link_offsets = np.frombuffer(offsets, dtype=np.int64).copy()
+        network.link_begin = begin.to_array()
+        network.link_end = end.to_array()
+        network.node_locations = locations.to_array()
+        return network
+
+    def link_records(self):
+        """ yields the tmdd dictionary of each link. """
+        coordinates = self.link_coordinates.tolist()
+        offsets = self.link_offsets.tolist()
+        begin = self.link_begin.tolist()
+        end = self.link_end.tolist()
+        for link in self.links:
+            i = link.index
+            yield link.to_record({'link-geom-location': [_location(p) for p in coordinates[offsets[i]:offsets[i + 1]]],
+                                  'link-begin-node-location': _location(begin[i]),
+                                  'link-end-node-location': _location(end[i])})
+
+    def node_records(self):
+        """ yields the tmdd dictionary of each node. """
+        locations = self.node_locations.tolist()
+        for node in self.nodes:
+            yield node.to_record({'node-location': _location(locations[node.index])})
+
+    def iter_fields(self):
+        """
+        Yields (section, key, value) triples as local_io.iter_tmdd does, with the inventories as iterators
+        of records, so local_io.write_tmdd_stream can write the network without building the document.
+        """
+        for section, fields in self.document.items():
+            for key, value in fields.items():
+                if key == 'link-inventory-list':
+                    value = self.link_records()
+                elif key == 'node-inventory-list':
+                    value = self.node_records()
+                yield section, key, value
+
+    def to_tmdd(self):
+        """
+        Rebuilds the tmdd document as nested dictionaries.
+        """
+        tmdd_object = {}
+        for section, key, value in self.iter_fields():
+            tmdd_object.setdefault(section, {})[key] = list(value) if key in INVENTORY_LISTS else value
+        return tmdd_object
+
+    def link_geometry(self, link):
+        """ the (n, 2) array of a link's vertices. """
+        return self.link_coordinates[self.link_offsets[link.index]:self.link_offsets[link.index + 1]]
+
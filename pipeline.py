@@ -0,0 +1,206 @@
+import argparse
+import multiprocessing
+import time
+
+import correct_distortion as cd
+import export_coordinate_csv as export
+import graph
+import local_io as io
+import profiling
+import simplify
+from network import Network
+
+"""
+corrects and exports each network in the data directory in one process. the extracted .json is parsed
+once into a network.Network, and every step works on it in memory, instead of handing over through a
+corrected .json that the next script reads and parses again.
+
+a step is a function (network, name) -> (network, name), where name is the network's current file name
+without the extension. steps that write files name them after it, so a pipeline of
+
+    [correct_step(cz), write_json_step(), export_csv_step()]
+
+writes the same net_corrected_2x1.json and net_corrected_2x1.csv as correct_distortion.py followed by
+export_coordinate_csv.py. writing the corrected .json is optional.
+"""
+
+
+def validate_step():
+    """ prints the missing node references and broken routes of the network, see graph.validate_network. """
+    def validate(network, name):
+        graph.print_report(name, graph.validate_network(network))
+        return network, name
+    return validate
+
+
+def simplify_step(tolerance):
+    """ simplifies the network's link geometry to within tolerance metres, see simplify.py. """
+    def simplify_geometry(network, name):
+        simplify.report(name, *simplify.simplify_model(network, tolerance))
+        return network, name
+    return simplify_geometry
+
+
+def correct_step(cz, formatted=cd.FORMAT):
+    """ corrects the network's coordinates with a fitted CorrectionZone or AdaptiveCorrectionZone. """
+    def correct(network, name):
+        cd.correct_model(cz, network, formatted)
+        return network, cd.corrected_name(cz, name)
+    return correct
+
+
+def write_json_step(path=None, **output):
+    """
+    writes the network as tmdd .json.
+    :param output: keyword arguments for local_io.write_tmdd_stream, e.g. compact=True, compress=True
+    """
+    def write_json(network, name):
+        io.write_tmdd_stream(network.iter_fields(), path or io.get_script_path('data'), name, **output)
+        return network, name
+    return write_json
+
+
+def export_csv_step(tiles=False):
+    """
+    writes the .csv of the network's link segments, as export_coordinate_csv.py does.
+    :param tiles: also write the spatial index and tiled .csv files, as export_coordinate_csv.py -tiles does
+    """
+    def export_csv(network, name):
+        with profiling.stage('export_csv', hot=True) as counts:
+            counts['segments'] = io.export_stream(export.HEADER, export.network_segment_rows(network), name)
+        if tiles:
+            export.export_tiles(network.link_coordinates, network.link_offsets,
+                                [link.link_id for link in network.links], name)
+        return network, name
+    return export_csv
+
+
+def build_steps(cz, write_json=False, output=None, tiles=False, validate=False, tolerance=None):
+    """
+    validation if validate, simplification if tolerance is given, correction, the corrected .json if
+    write_json, then the .csv export, with tiles if tiles.
+    """
+    steps = [validate_step()] if validate else []
+    if tolerance is not None:
+        steps.append(simplify_step(tolerance))
+    steps.append(correct_step(cz))
+    if write_json:
+        steps.append(write_json_step(**(output or {})))
+    steps.append(export_csv_step(tiles))
+    return steps
+
+
+def run_pipeline(file, steps):
+    """
+    Parses one .json network in the data directory and runs each step on it in turn.
+    :return: the file name without the extension, and the number of seconds taken
+    """
+    start = time.perf_counter()
+    key = io.network_name(file)
+    print('Processing', key)
+
+    with profiling.network(key):
+        with profiling.stage('build_network'):
+            network = Network.from_stream(io.iter_tmdd(io.get_script_path('data') + io.separator() + file))
+        name = key
+        for step in steps:
+            network, name = step(network, name)
+
+    return key, time.perf_counter() - start
+
+
+""" the steps built by each pool worker once at startup, from the zones fitted by the parent process. """
+_worker_steps = None
+
+
+def _init_worker(cz, write_json, output, tiles, validate, tolerance, profile, cprofile_path, trace_memory):
+    global _worker_steps
+    _worker_steps = build_steps(cz, write_json, output, tiles, validate, tolerance)
+    if profile:
+        profiling.enable(profiling.worker_cprofile_path(cprofile_path), trace_memory)
+
+
+def _run_pipeline_worker(file):
+    return run_pipeline(file, _worker_steps), profiling.PROFILER.drain()
+
+
+def run_pipelines(cz, files, write_json=False, output=None, jobs=1, tiles=False, validate=False, tolerance=None):
+    """
+    Runs the pipeline of build_steps on each file, spreading them across a pool of jobs processes if jobs > 1.
+    :return: a list of (file name without the extension, seconds) in the order files finished
+    """
+    if jobs > 1 and len(files) > 1:
+        results = []
+        initargs = (cz, write_json, output, tiles, validate, tolerance,
+                    profiling.PROFILER.enabled, profiling.PROFILER.cprofile_path, profiling.PROFILER.trace_memory)
+        with multiprocessing.Pool(min(jobs, len(files)), initializer=_init_worker, initargs=initargs) as pool:
+            for result, records in pool.imap_unordered(_run_pipeline_worker, files):
+                profiling.PROFILER.merge(records)
+                results.append(result)
+        return results
+    steps = build_steps(cz, write_json, output, tiles, validate, tolerance)
+    return [run_pipeline(file, steps) for file in files]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-horizontal", type=int,
+                        help="the number of horizontal zones")
+    parser.add_argument("-vertical", type=int,
+                        help="the number of vertical zones")
+    parser.add_argument("-adaptive", type=int,
+                        help="partition adaptively with a k-d tree instead, with at least this many control points per zone")
+    parser.add_argument("-no-cache", action="store_true",
+                        help="refit the zones instead of reusing fitted zones from the cache")
+    parser.add_argument("-write-json", action="store_true",
+                        help="also write the corrected .json, as correct_distortion.py does")
+    parser.add_argument("-minify", action="store_true",
+                        help="write the corrected .json without indentation")
+    parser.add_argument("-gzip", action="store_true",
+                        help="write the corrected .json gzip compressed, as .json.gz")
+    parser.add_argument("-fast-json", action="store_true",
+                        help="encode the corrected .json with orjson, if it is installed")
+    parser.add_argument("-tiles", action="store_true",
+                        help="also write a spatial index of each network's links and its .csv split into tiles")
+    parser.add_argument("-validate", action="store_true",
+                        help="check each network's node references and routes before correcting it, as graph.py does")
+    parser.add_argument("-simplify", type=float, metavar='METRES',
+                        help="drop link geometry vertices within METRES of the simplified line before correcting")
+    parser.add_argument("-jobs", "--jobs", type=int, default=1,
+                        help="the number of files to process in parallel")
+    parser.add_argument("-profile", "--profile", nargs='?', const='', metavar='REPORT',
+                        help="print the time, peak resident memory and item counts of each stage of each file, "
+                             "and write them to REPORT as json if given")
+    parser.add_argument("-cprofile", metavar='PATH',
+                        help="capture the correction and export loops with cProfile and write the stats to PATH (implies -profile)")
+    parser.add_argument("-trace-memory", action="store_true",
+                        help="also trace allocations to record the peak memory of each stage (implies -profile). "
+                             "slows the run, some stages far more than others")
+    args = parser.parse_args()
+
+    assert args.adaptive or (args.horizontal and args.vertical), "-horizontal, -vertical (or -adaptive) are required. example usage: \'py pipeline.py -horizontal 2 -vertical 1\'"
+
+    if args.profile is not None or args.cprofile or args.trace_memory:
+        profiling.enable(args.cprofile, args.trace_memory)
+
+    with profiling.stage('fit_zones'):
+        if args.adaptive:
+            cz = cd.AdaptiveCorrectionZone(args.adaptive, cache=not args.no_cache)
+        else:
+            cz = cd.CorrectionZone(args.horizontal, args.vertical, cache=not args.no_cache)
+
+    start = time.perf_counter()
+    files = [file for file in io.get_JSON_files() if 'corrected' not in file]
+    output = {'compact': args.minify, 'compress': args.gzip, 'fast': args.fast_json}
+    results = run_pipelines(cz, files, args.write_json, output, args.jobs, args.tiles, args.validate, args.simplify)
+
+    print('processed {0} files in {1:.2f}s using {2} jobs'.format(len(results), time.perf_counter() - start, args.jobs))
+    for key, seconds in sorted(results):
+        print('  {0}: {1:.2f}s'.format(key, seconds))
+
+    if profiling.PROFILER.enabled:
+        profiling.PROFILER.finish(args.profile)
+
+
+if __name__ == '__main__':
+    main()
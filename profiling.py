@@ -0,0 +1,201 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not on windows, where the peak resident memory is not reported
+
+"""
+lightweight per-stage instrumentation shared by correct_distortion.py, export_coordinate_csv.py and local_io.
+
+    with profiling.network(key):
+        with profiling.stage('json.loads'):
+            ...
+        with profiling.stage('correct', hot=True) as counts:
+            ...
+            counts['links'] = len(links)
+
+stages cost a function call while profiling is disabled. once enabled, each stage records its wall time,
+the peak resident memory of the process when it ends (via getrusage), and any item counts it reports.
+tracing allocations with tracemalloc also records the peak memory allocated above each stage's start,
+but slows every allocation, and so pure python stages far more than numpy ones, so it is opt in and its
+timings should not be compared with untraced ones. stages marked hot are also captured by cProfile if a
+cProfile path was given.
+"""
+
+
+MEASURES = ('network', 'stage', 'seconds', 'max_rss_bytes', 'peak_bytes')
+# the fields of a record that are not item counts
+PEAKS = ('max_rss_bytes', 'peak_bytes')
+# the fields of a record summarized by their largest value
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.records = []
+        self.current_network = None
+        self.cprofile_path = None
+        self._cprofile = None
+        self._hot_depth = 0
+        self._captured = False
+        self._stack = []
+
+    def enable(self, cprofile_path=None, trace_memory=False):
+        """
+        :param cprofile_path: if given, hot stages are captured by cProfile and written here. pool workers
+        should each be given their own path.
+        :param trace_memory: if true, also trace allocations to record the peak memory of each stage
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile_path:
+            self.cprofile_path = cprofile_path
+            self._cprofile = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def network(self, name):
+        """ attributes the stages run inside the block to the network name. """
+        previous = self.current_network
+        self.current_network = name
+        try:
+            yield
+        finally:
+            self.current_network = previous
+
+    @contextlib.contextmanager
+    def stage(self, name, hot=False, **counts):
+        """
+        records the block as one run of stage name. yields a dictionary of item counts the block may update.
+        """
+        if not self.enabled:
+            yield counts
+            return
+
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame = {'base': current, 'peak': current}
+            self._stack.append(frame)
+
+        if hot and self._cprofile is not None:
+            if self._hot_depth == 0:
+                self._cprofile.enable()
+            self._hot_depth += 1
+            self._captured = True
+
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            elapsed = time.perf_counter() - start
+            if hot and self._cprofile is not None:
+                self._hot_depth -= 1
+                if self._hot_depth == 0:
+                    self._cprofile.disable()
+
+            record = {'network': self.current_network, 'stage': name, 'seconds': elapsed,
+                      'max_rss_bytes': max_rss_bytes()}
+            if self.trace_memory:
+                self._stack.pop()
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+                record['peak_bytes'] = peak - frame['base']
+            record.update(counts)
+            self.records.append(record)
+
+    def drain(self):
+        """
+        returns and forgets the records so far, to send them from a pool worker to the parent. the
+        worker's cProfile capture so far is written out, as the worker may exit without finishing.
+        """
+        records, self.records = self.records, []
+        if self._captured:
+            self._cprofile.dump_stats(self.cprofile_path)
+        return records
+
+    def merge(self, records):
+        """ adds records drained from a pool worker. """
+        self.records.extend(records)
+
+    def summary(self):
+        """
+        sums the records of each stage of each network, in the order they first ran. max_rss_bytes and
+        peak_bytes are the largest of any run.
+        """
+        totals = {}
+        for record in self.records:
+            key = (record['network'], record['stage'])
+            if key not in totals:
+                totals[key] = dict(record, runs=0, seconds=0.0)
+                for count in record:
+                    if count not in MEASURES:
+                        totals[key][count] = 0
+            total = totals[key]
+            total['runs'] += 1
+            total['seconds'] += record['seconds']
+            for peak in PEAKS:
+                if record.get(peak) is not None:
+                    total[peak] = max(total.get(peak) or 0, record[peak])
+            for count, value in record.items():
+                if count not in MEASURES:
+                    total[count] = total.get(count, 0) + value
+        return list(totals.values())
+
+    def report(self):
+        """ prints the summary. max RSS is the process's peak resident memory by the end of the stage. """
+        mebibytes = lambda value: '-' if value is None else '{0:.1f}'.format(value / 2.0 ** 20)
+        print('{0:<32} {1:<20} {2:>10} {3:>12} {4:>12}  {5}'.format('network', 'stage', 'seconds', 'max RSS MiB',
+                                                                    'traced MiB', 'items'))
+        for total in self.summary():
+            items = ', '.join('{0}={1}'.format(k, v) for k, v in total.items() if k not in MEASURES + ('runs',))
+            print('{0:<32} {1:<20} {2:>10.4f} {3:>12} {4:>12}  {5}'.format(
+                total['network'] or '-', total['stage'], total['seconds'], mebibytes(total.get('max_rss_bytes')),
+                mebibytes(total.get('peak_bytes')), items))
+
+    def dump(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump({'stages': self.summary(), 'records': self.records}, f, indent=2)
+
+    def finish(self, report_path=None):
+        """ prints the summary, writes it to report_path as json if given, and writes the cProfile capture. """
+        self.report()
+        if report_path:
+            self.dump(report_path)
+            print('Writing', report_path)
+        if self._captured:
+            self._cprofile.dump_stats(self.cprofile_path)
+            print('Writing', self.cprofile_path)
+
+
+def max_rss_bytes():
+    """ the peak resident memory of the process so far, or None where getrusage is not available. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    """ linux reports kibibytes, macos bytes. """
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+PROFILER = Profiler()
+
+enable = PROFILER.enable
+network = PROFILER.network
+stage = PROFILER.stage
+
+
+def worker_cprofile_path(cprofile_path):
+    """ the cProfile path for the current pool worker process. """
+    return '{0}.{1}'.format(cprofile_path, os.getpid()) if cprofile_path else None
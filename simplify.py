@@ -0,0 +1,166 @@
+import itertools
+
+import numpy as np
+
+import profiling
+from network import METRES_PER_DEGREE, TMDD_SCALE
+
+"""
+simplifies link geometry with the Douglas-Peucker algorithm, dropping vertices that lie within a tolerance
+in metres of the line through the vertices kept around them. the first and last vertex of each link, which
+the aimsun exporter sets to its begin and end node locations, are always kept, and kept vertices are never
+moved, so node locations stay exact.
+
+every link is simplified at once: each pass finds the farthest vertex of every open range of every link,
+keeps it if it is beyond the tolerance, and splits the range around it. each link is projected to metres
+about the latitude of its first vertex, so a link simplifies the same whichever links it is batched with.
+"""
+
+BATCH_SIZE = 10000
+# links simplified together when records are streamed
+
+
+def projected(coordinates, offsets):
+    """
+    :param coordinates: a (V, 2) array of [lon, lat] rows, in degrees, or TMDD formatted if integer
+    :param offsets: link i's vertices are coordinates[offsets[i]:offsets[i + 1]]
+    :return: the coordinates as a (V, 2) float array of metres east and north
+    """
+    coordinates = np.asarray(coordinates)
+    degrees = coordinates / TMDD_SCALE if coordinates.dtype.kind == 'i' else coordinates.astype(float)
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    latitudes = np.repeat(degrees[offsets[:-1][counts > 0], 1], counts[counts > 0])
+    return degrees * np.column_stack((np.cos(np.radians(latitudes)), np.ones(len(latitudes)))) * METRES_PER_DEGREE
+
+
+def segment_distances(points, a, b):
+    """ the distance of each of points from the segment between the matching rows of a and b. """
+    ab = b - a
+    length = np.einsum('ij,ij->i', ab, ab)
+    t = np.einsum('ij,ij->i', points - a, ab) / np.where(length > 0, length, 1.0)
+    closest = a + np.clip(t, 0.0, 1.0)[:, None] * ab
+    return np.hypot(*(points - closest).T)
+
+
+def douglas_peucker(points, offsets, tolerance):
+    """
+    :param points: a (V, 2) array of the vertices of every link, in metres
+    :param offsets: link i's vertices are points[offsets[i]:offsets[i + 1]]
+    :param tolerance: the largest distance in metres a dropped vertex may lie from the simplified line
+    :return: a boolean mask of the vertices to keep
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[offsets[:-1][counts > 0]] = True
+    keep[offsets[1:][counts > 0] - 1] = True
+
+    """ the open ranges, as the first and last vertex of each, both already kept. """
+    starts, ends = offsets[:-1][counts > 2], offsets[1:][counts > 2] - 1
+    while len(starts):
+        interior = ends - starts - 1
+        group = np.repeat(np.arange(len(starts)), interior)
+        vertex = np.repeat(starts + 1, interior) + np.arange(interior.sum()) - np.repeat(np.cumsum(interior) - interior, interior)
+        distances = segment_distances(points[vertex], points[starts[group]], points[ends[group]])
+
+        farthest = np.maximum.reduceat(distances, np.cumsum(interior) - interior)
+        """ the first vertex of each range at its farthest distance. """
+        at_farthest = np.flatnonzero(distances == farthest[group])
+        _, first = np.unique(group[at_farthest], return_index=True)
+        split = farthest > tolerance
+        pivots = vertex[at_farthest[first]][split]
+        keep[pivots] = True
+
+        starts, ends = np.concatenate((starts[split], pivots)), np.concatenate((pivots, ends[split]))
+        open_ranges = ends - starts > 1
+        starts, ends = starts[open_ranges], ends[open_ranges]
+    return keep
+
+
+def simplify_arrays(link_coordinates, link_offsets, tolerance):
+    """
+    :param link_coordinates: a (V, 2) array of the vertices of every link, link after link
+    :param link_offsets: link i's vertices are link_coordinates[link_offsets[i]:link_offsets[i + 1]]
+    :return: the kept vertices, in the same dtype, and their offsets
+    """
+    with profiling.stage('simplify', hot=True, vertices=len(link_coordinates)) as counts:
+        keep = douglas_peucker(projected(link_coordinates, link_offsets), link_offsets, tolerance)
+        kept_before = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept_before[1:])
+        counts['kept'] = int(kept_before[-1])
+    return np.asarray(link_coordinates)[keep], kept_before[np.asarray(link_offsets)]
+
+
+def simplify_model(network, tolerance):
+    """
+    Simplifies the geometry of a network.Network in place.
+    :return: the number of vertices before and after
+    """
+    before = len(network.link_coordinates)
+    network.link_coordinates, network.link_offsets = simplify_arrays(network.link_coordinates, network.link_offsets,
+                                                                     tolerance)
+    return before, len(network.link_coordinates)
+
+
+def simplify_columns(columns, tolerance):
+    """
+    Simplifies the geometry of a NetworkColumns, replacing its (possibly memory mapped) arrays.
+    :return: the number of vertices before and after
+    """
+    before = len(columns.arrays['link_coordinates'])
+    columns.arrays['link_coordinates'], columns.arrays['link_offsets'] = simplify_arrays(
+        columns.arrays['link_coordinates'], columns.arrays['link_offsets'], tolerance)
+    return before, len(columns.arrays['link_coordinates'])
+
+
+def simplify_records(link_inventory, tolerance):
+    """
+    Simplifies the link-geom-location of a list of link inventory records in place.
+    :return: the number of vertices before and after
+    """
+    geometry = [link['link-geom-location'] for link in link_inventory]
+    offsets = np.zeros(len(geometry) + 1, dtype=np.int64)
+    np.cumsum([len(points) for points in geometry], out=offsets[1:])
+    """ integer coordinates stay integer in the array, marking them as TMDD formatted. """
+    coordinates = np.array([(p['longitude'], p['latitude']) for points in geometry for p in points]).reshape(-1, 2)
+
+    with profiling.stage('simplify', hot=True, vertices=len(coordinates)) as counts:
+        keep = douglas_peucker(projected(coordinates, offsets), offsets, tolerance).tolist()
+        for link, points, start in zip(link_inventory, geometry, offsets.tolist()):
+            kept = keep[start:start + len(points)]
+            if not all(kept):
+                link['link-geom-location'] = list(itertools.compress(points, kept))
+        counts['kept'] = sum(keep)
+    return len(keep), counts['kept']
+
+
+def simplify_iter(link_inventory, tolerance, totals, batch_size=BATCH_SIZE):
+    """
+    Simplifies link inventory records batch_size at a time as they are consumed.
+    :param totals: a dictionary whose 'before' and 'after' vertex counts are increased batch by batch
+    """
+    while True:
+        batch = list(itertools.islice(link_inventory, batch_size))
+        if not batch:
+            return
+        before, after = simplify_records(batch, tolerance)
+        totals['before'] = totals.get('before', 0) + before
+        totals['after'] = totals.get('after', 0) + after
+        yield from batch
+
+
+def simplify_stream(fields, tolerance, totals, batch_size=BATCH_SIZE):
+    """
+    Simplifies the link inventory of (section, key, value) triples as yielded by local_io.iter_tmdd.
+    :param totals: as simplify_iter
+    """
+    for section, key, value in fields:
+        if key == 'link-inventory-list':
+            value = simplify_iter(iter(value), tolerance, totals, batch_size)
+        yield section, key, value
+
+
+def report(key, before, after):
+    print('  simplified {0}: {1} -> {2} vertices ({3:.1f}% fewer)'.format(
+        key, before, after, 100.0 * (before - after) / before if before else 0.0))
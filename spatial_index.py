@@ -0,0 +1,241 @@
+import os
+
+import numpy as np
+
+import local_io as io
+from network import TMDD_SCALE
+
+"""
+a uniform grid index over the link geometry of a network, so the links and segments within a lon/lat
+window can be found without scanning the link inventory.
+
+the grid divides the plane into square tiles of tile_size. each link is listed under every tile its
+bounding box overlaps, in compressed sparse rows: the links of tile t are
+tile_links[tile_offsets[t]:tile_offsets[t + 1]], where t = row * columns + column counted from the tile
+at origin. a query reads the tiles the window overlaps and keeps the links whose bounding box intersects it.
+
+the index is saved as <name>.index.npz alongside the network's .csv, holding the link geometry too, so
+queries need nothing else. coordinates keep the network's units: TMDD formatted networks store degrees
+times 10 ** DIGIT_PRECISION, and scale records that factor. query windows are always given in degrees.
+"""
+
+INDEX_EXTENSION = '.index.npz'
+TILES_EXTENSION = '.tiles'
+FORMAT_VERSION = 1
+TILE_DEGREES = 0.01
+# the side of each tile, about 1 km
+
+
+def bounding_boxes(link_coordinates, link_offsets):
+    """
+    :return: an (L, 4) array of [min lon, min lat, max lon, max lat] rows, one per link. links without
+    vertices get an empty box of nan.
+    """
+    offsets = np.asarray(link_offsets)
+    counts = np.diff(offsets)
+    boxes = np.full((len(counts), 4), np.nan)
+    present = counts > 0
+    if present.any():
+        coordinates = np.asarray(link_coordinates, dtype=float)
+        starts = offsets[:-1][present]
+        boxes[present, :2] = np.minimum.reduceat(coordinates, starts, axis=0)
+        boxes[present, 2:] = np.maximum.reduceat(coordinates, starts, axis=0)
+        """ reduceat reduces up to the next start, so each link's last start must be followed by its end. """
+        last = np.nonzero(present)[0][-1]
+        boxes[last, :2] = coordinates[offsets[last]:offsets[last + 1]].min(axis=0)
+        boxes[last, 2:] = coordinates[offsets[last]:offsets[last + 1]].max(axis=0)
+    return boxes
+
+
+def tile_ranges(boxes, origin, tile_size):
+    """ the first and last tile column and row each box overlaps, as four integer arrays. """
+    low = np.floor((boxes[:, :2] - origin) / tile_size).astype(np.int64)
+    high = np.floor((boxes[:, 2:] - origin) / tile_size).astype(np.int64)
+    return low[:, 0], low[:, 1], high[:, 0], high[:, 1]
+
+
+def tile_pairs(boxes, origin, tile_size, columns):
+    """
+    lists every (tile, item) pair where the item's box overlaps the tile.
+    :return: two integer arrays, the tile of each pair and the row of boxes it came from
+    """
+    x0, y0, x1, y1 = tile_ranges(boxes, origin, tile_size)
+    widths = x1 - x0 + 1
+    counts = widths * (y1 - y0 + 1)
+    items = np.repeat(np.arange(len(boxes)), counts)
+    """ the position of each pair among its item's tiles, walked row by row. """
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = y0[items] + k // widths[items]
+    cols = x0[items] + k % widths[items]
+    return rows * columns + cols, items
+
+
+class SpatialIndex:
+    def __init__(self, arrays):
+        """
+        Use build or read to make one.
+        :param arrays: maps array name -> np.ndarray, as saved in the index file
+        """
+        self.arrays = arrays
+        self.scale = float(arrays['scale'])
+        self.tile_size = float(arrays['tile_size'])
+        self.origin = arrays['origin']
+        self.rows, self.columns = (int(n) for n in arrays['shape'])
+        self.boxes = arrays['boxes']
+
+    @property
+    def link_count(self):
+        return len(self.boxes)
+
+    @classmethod
+    def build(cls, link_coordinates, link_offsets, link_ids=None, tile_degrees=TILE_DEGREES):
+        """
+        :param link_coordinates: a (V, 2) array of the vertices of every link, link after link
+        :param link_offsets: link i's vertices are link_coordinates[link_offsets[i]:link_offsets[i + 1]]
+        :param link_ids: the link-id of each link, if known
+        """
+        link_coordinates = np.asarray(link_coordinates)
+        scale = TMDD_SCALE if link_coordinates.dtype.kind == 'i' else 1
+        tile_size = tile_degrees * scale
+
+        boxes = bounding_boxes(link_coordinates, link_offsets)
+        valid = ~np.isnan(boxes[:, 0])
+        if valid.any():
+            origin = np.floor(np.nanmin(boxes[:, :2], axis=0) / tile_size) * tile_size
+            x1, y1 = tile_ranges(boxes[valid], origin, tile_size)[2:]
+            rows, columns = int(y1.max()) + 1, int(x1.max()) + 1
+        else:
+            origin, rows, columns = np.zeros(2), 0, 0
+
+        tiles, items = tile_pairs(boxes[valid], origin, tile_size, columns)
+        items = np.nonzero(valid)[0][items]
+        order = np.argsort(tiles, kind='stable')
+        tile_offsets = np.zeros(rows * columns + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tiles, minlength=rows * columns), out=tile_offsets[1:])
+
+        arrays = {'version': np.array(FORMAT_VERSION), 'scale': np.array(scale), 'tile_size': np.array(tile_size),
+                  'origin': origin, 'shape': np.array([rows, columns]), 'boxes': boxes,
+                  'tile_offsets': tile_offsets, 'tile_links': items[order],
+                  'link_coordinates': link_coordinates, 'link_offsets': np.asarray(link_offsets, dtype=np.int64)}
+        if link_ids is not None:
+            arrays['link_ids'] = np.array([str(link_id) for link_id in link_ids])
+        return cls(arrays)
+
+    @classmethod
+    def from_network(cls, network, tile_degrees=TILE_DEGREES):
+        """ indexes a network.Network. """
+        return cls.build(network.link_coordinates, network.link_offsets, [link.link_id for link in network.links],
+                         tile_degrees)
+
+    def write(self, path, filename):
+        np.savez(path + io.separator() + filename + INDEX_EXTENSION, **self.arrays)
+
+    @classmethod
+    def read(cls, path, filename):
+        """
+        :param filename: the network name, with or without INDEX_EXTENSION
+        """
+        if not filename.endswith(INDEX_EXTENSION):
+            filename += INDEX_EXTENSION
+        with np.load(path + io.separator() + filename) as f:
+            arrays = {name: f[name] for name in f.files}
+        assert int(arrays['version']) == FORMAT_VERSION, 'unsupported index version {0}'.format(arrays['version'])
+        return cls(arrays)
+
+    def __window(self, min_lon, min_lat, max_lon, max_lat):
+        return np.array([min_lon, min_lat, max_lon, max_lat], dtype=float) * self.scale
+
+    def __candidates(self, window):
+        """ the links listed under any tile the window overlaps, without repeats. """
+        if self.rows == 0:
+            return np.empty(0, dtype=np.int64)
+        x0, y0, x1, y1 = (int(v[0]) for v in tile_ranges(window[None, :], self.origin, self.tile_size))
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.columns - 1), min(y1, self.rows - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+        offsets = self.arrays['tile_offsets']
+        tile_links = self.arrays['tile_links']
+        links = [tile_links[offsets[row * self.columns + x0]:offsets[row * self.columns + x1 + 1]]
+                 for row in range(y0, y1 + 1)]
+        return np.unique(np.concatenate(links))
+
+    def query_links(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        :return: the indices, in link inventory order, of the links whose bounding box intersects the window
+        """
+        window = self.__window(min_lon, min_lat, max_lon, max_lat)
+        links = self.__candidates(window)
+        boxes = self.boxes[links]
+        hit = (boxes[:, 0] <= window[2]) & (boxes[:, 2] >= window[0]) & \
+              (boxes[:, 1] <= window[3]) & (boxes[:, 3] >= window[1])
+        return links[hit]
+
+    def link_ids(self, links):
+        """ the link-id of each of the given links, or their indices if the index has no link-ids. """
+        if 'link_ids' not in self.arrays:
+            return np.asarray(links).tolist()
+        return self.arrays['link_ids'][links].tolist()
+
+    def link_geometry(self, link):
+        """ the (n, 2) array of a link's vertices. """
+        offsets = self.arrays['link_offsets']
+        return self.arrays['link_coordinates'][offsets[link]:offsets[link + 1]]
+
+    def query_segments(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        :return: an (S, 2) array of segment sources, an (S, 2) array of segment targets, and the index of
+        each segment's link, for the segments whose bounding box intersects the window
+        """
+        window = self.__window(min_lon, min_lat, max_lon, max_lat)
+        links = self.query_links(min_lon, min_lat, max_lon, max_lat)
+        sources, targets, link_index = link_segments(self, links)
+        low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+        hit = (low[:, 0] <= window[2]) & (high[:, 0] >= window[0]) & (low[:, 1] <= window[3]) & (high[:, 1] >= window[1])
+        return sources[hit], targets[hit], link_index[hit]
+
+
+def link_segments(index, links):
+    """
+    :param links: link indices of the index
+    :return: as export_coordinate_csv.geometry_segments, with the index of each segment's link in place of its position
+    """
+    offsets = index.arrays['link_offsets']
+    links = np.asarray(links, dtype=np.int64)
+    counts = np.maximum(offsets[links + 1] - offsets[links] - 1, 0)
+    """ the vertices starting each segment, counted up from the first vertex of each link. """
+    sources = np.repeat(offsets[links], counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    coordinates = index.arrays['link_coordinates']
+    return (np.asarray(coordinates[sources], dtype=float).reshape(-1, 2),
+            np.asarray(coordinates[sources + 1], dtype=float).reshape(-1, 2), np.repeat(links, counts))
+
+
+def tile_segment_rows(index, sources, targets, link_index):
+    """
+    groups segments into the tiles their bounding box overlaps.
+    :return: a dictionary mapping each (column, row) tile to the indices of its segments. tiles are numbered
+    from 0 degrees, so tile (column, row) spans column * tile_size to (column + 1) * tile_size in longitude.
+    """
+    boxes = np.hstack((np.minimum(sources, targets), np.maximum(sources, targets)))
+    tiles, items = tile_pairs(boxes, index.origin, index.tile_size, index.columns)
+    order = np.argsort(tiles, kind='stable')
+    tiles, items = tiles[order], items[order]
+    starts = np.flatnonzero(np.r_[True, tiles[1:] != tiles[:-1]]) if len(tiles) else np.empty(0, dtype=np.intp)
+    ends = np.r_[starts[1:], len(tiles)]
+    first_column, first_row = (int(v) for v in np.round(index.origin / index.tile_size))
+    return {(first_column + int(tiles[s] % index.columns), first_row + int(tiles[s] // index.columns)): items[s:e]
+            for s, e in zip(starts, ends)}
+
+
+def tile_name(filename, tile):
+    """ the name, relative to the data directory and without the extension, of a tile's .csv. """
+    return filename + TILES_EXTENSION + io.separator() + '{0}_{1}'.format(*tile)
+
+
+def make_tiles_directory(path, filename):
+    """ creates the directory of a network's tiles, removing any tiles left by an earlier export. """
+    directory = path + io.separator() + filename + TILES_EXTENSION
+    os.makedirs(directory, exist_ok=True)
+    for file in os.listdir(directory):
+        if file.endswith('.csv'):
+            os.remove(directory + io.separator() + file)
@@ -0,0 +1,269 @@
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import correct_distortion as cd
+from network import METRES_PER_DEGREE
+
+"""
+compares zone configurations by how well they predict control points they were not fit to, without
+correcting any network. run from the repository directory.
+
+each configuration partitions the control points as CorrectionZone or AdaptiveCorrectionZone would and
+fits every zone's affine matrix. its error is the cross-validated residual of each control point: the
+distance between the point's google location and its aimsun location corrected by matrices fit without it.
+leave-one-out residuals come from the hat matrix of each zone's least squares fit, so every point is
+scored from a single fit of all zones. a point left alone in a zone with too few points to fit is
+predicted with the degenerate matrix CorrectionZone uses for such zones.
+
+with k folds, the zones are fit k times on the other folds instead. either way the partition is the one
+fit to all control points.
+"""
+
+FALLBACK_MATRIX = np.linalg.lstsq([[1, 1, 1]], [[1, 1]], rcond=None)[0]
+# the matrix CorrectionZone gives zones with fewer than 3 control points
+MIN_FIT_POINTS = 3
+# zones fit on fewer control points use FALLBACK_MATRIX
+
+
+def load_samples():
+    """ the aimsun and google control points, as two (N, 2) arrays. """
+    return np.array(cd.load_data('aimsun_samples')), np.array(cd.load_data('google_samples'))
+
+
+def fit_zone(configuration):
+    """
+    :param configuration: ('grid', horizontal, vertical) or ('adaptive', min_samples)
+    :return: the uncached CorrectionZone or AdaptiveCorrectionZone, fit without printing its partition
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if configuration[0] == 'grid':
+            return cd.CorrectionZone(configuration[1], configuration[2], cache=False)
+        return cd.AdaptiveCorrectionZone(configuration[1], cache=False)
+
+
+def zone_assignment(cz, points):
+    """
+    :return: the zone index of each point, and the number of zones
+    """
+    if isinstance(cz, cd.AdaptiveCorrectionZone):
+        return cz.zone_indices(points), len(cz.transformation_matrices)
+    lat_index, lon_index = cz.bucket_indices(points)
+    return lat_index * cz.horizontal_zones + lon_index, cz.horizontal_zones * cz.vertical_zones
+
+
+def design_matrix(source):
+    """
+    [lon, lat, 1] rows, centred on the mean control point. an affine fit is unchanged by the shift, and
+    the normal equations are far better conditioned without the -118, 34 offset.
+    """
+    centred = source - source.mean(axis=0)
+    return np.hstack((centred, np.ones((len(source), 1))))
+
+
+def normal_equations(x, y, zones, zone_count):
+    """ per zone sums of x^T x, (Z, 3, 3), and x^T y, (Z, 3, 2). """
+    xtx = np.zeros((zone_count, 3, 3))
+    xty = np.zeros((zone_count, 3, 2))
+    np.add.at(xtx, zones, x[:, :, None] * x[:, None, :])
+    np.add.at(xty, zones, x[:, :, None] * y[:, None, :])
+    return xtx, xty
+
+
+def fallback_predictions(source):
+    return np.hstack((source, np.ones((len(source), 1)))) @ FALLBACK_MATRIX
+
+
+def loo_residuals(source, target, zones, zone_count):
+    """
+    leave-one-out residuals of every control point, from one fit of all zones. for a least squares fit
+    with hat matrix H, the residual of point i under the fit without it is e_i / (1 - H_ii). points left
+    with too few others in their zone are predicted with FALLBACK_MATRIX.
+    :return: the (N, 2) cross-validated residuals, the (N, 2) residuals of the fit to all points, and a
+    mask of the points predicted with FALLBACK_MATRIX
+    """
+    x = design_matrix(source)
+    counts = np.bincount(zones, minlength=zone_count)
+    xtx, xty = normal_equations(x, target, zones, zone_count)
+    inverse = np.linalg.pinv(xtx)
+    matrices = inverse @ xty
+
+    fitted = np.einsum('ni,nij->nj', x, matrices[zones])
+    fitted[counts[zones] < MIN_FIT_POINTS] = fallback_predictions(source[counts[zones] < MIN_FIT_POINTS])
+    residuals = target - fitted
+
+    leverage = np.einsum('ni,nij,nj->n', x, inverse[zones], x)
+    underfit = counts[zones] - 1 < MIN_FIT_POINTS
+    """ points with leverage near 1 are refit without them explicitly, as dividing by 1 - leverage is unstable. """
+    unstable = ~underfit & (1 - leverage < 1e-6)
+    loo = residuals / np.where(underfit | unstable, 1.0, 1 - leverage)[:, None]
+    loo[underfit] = target[underfit] - fallback_predictions(source[underfit])
+    for i in np.nonzero(unstable)[0]:
+        rest = (zones == zones[i]) & (np.arange(len(x)) != i)
+        loo[i] = target[i] - x[i] @ np.linalg.lstsq(x[rest], target[rest], rcond=None)[0]
+    return loo, residuals, underfit
+
+
+def kfold_residuals(source, target, zones, zone_count, folds, seed=0):
+    """
+    residuals of every control point under zones fit on the other folds. points are dealt into folds
+    at random. the normal equations of all points are computed once, and each fold's are subtracted.
+    :return: as loo_residuals
+    """
+    x = design_matrix(source)
+    fold = np.random.RandomState(seed).permutation(len(source)) % folds
+    xtx, xty = normal_equations(x, target, zones, zone_count)
+    counts = np.bincount(zones, minlength=zone_count)
+
+    predictions = np.empty_like(target)
+    fallback = np.zeros(len(source), dtype=bool)
+    for k in range(folds):
+        held = fold == k
+        held_xtx, held_xty = normal_equations(x[held], target[held], zones[held], zone_count)
+        matrices = np.linalg.pinv(xtx - held_xtx) @ (xty - held_xty)
+        predictions[held] = np.einsum('ni,nij->nj', x[held], matrices[zones[held]])
+
+        train_counts = counts - np.bincount(zones[held], minlength=zone_count)
+        underfit = held & (train_counts[zones] < MIN_FIT_POINTS)
+        predictions[underfit] = fallback_predictions(source[underfit])
+        fallback |= underfit
+
+    _, residuals, _ = loo_residuals(source, target, zones, zone_count)
+    return target - predictions, residuals, fallback
+
+
+def metres(residuals, latitudes):
+    """ the length of each (lon, lat) residual in metres. """
+    scale = np.column_stack((np.cos(np.radians(latitudes)), np.ones(len(latitudes)))) * METRES_PER_DEGREE
+    return np.hypot(*(residuals * scale).T)
+
+
+def evaluate(configuration, folds=None, samples=None):
+    """
+    :param configuration: see fit_zone
+    :param folds: the number of folds, or None for leave-one-out
+    :param samples: the (source, target) control points, loaded from the sample files if None
+    :return: a dictionary describing the configuration's errors in metres
+    """
+    source, target = samples if samples is not None else load_samples()
+    cz = fit_zone(configuration)
+    zones, zone_count = zone_assignment(cz, source)
+    if folds:
+        validation, fit, fallback = kfold_residuals(source, target, zones, zone_count, folds)
+    else:
+        validation, fit, fallback = loo_residuals(source, target, zones, zone_count)
+
+    errors = metres(validation, target[:, 1])
+    counts = np.bincount(zones, minlength=zone_count)
+    return {'layout': cz.layout,
+            'zones': zone_count,
+            'underfit_zones': int(np.count_nonzero(counts < MIN_FIT_POINTS)),
+            'fallback_points': int(np.count_nonzero(fallback)),
+            'min_points': int(counts.min()),
+            'rmse_m': float(np.sqrt(np.mean(errors ** 2))),
+            'median_m': float(np.median(errors)),
+            'max_m': float(errors.max()),
+            'fit_rmse_m': float(np.sqrt(np.mean(metres(fit, target[:, 1]) ** 2)))}
+
+
+def configurations(max_horizontal, max_vertical, adaptive):
+    grid = [('grid', h, v) for h, v in itertools.product(range(1, max_horizontal + 1), range(1, max_vertical + 1))]
+    return grid + [('adaptive', m) for m in adaptive]
+
+
+""" the control points, loaded by each pool worker once at startup. """
+_worker_samples = None
+
+
+def _init_worker():
+    global _worker_samples
+    _worker_samples = load_samples()
+
+
+def _evaluate_worker(task):
+    configuration, folds = task
+    return evaluate(configuration, folds, _worker_samples)
+
+
+def search(configurations, folds=None, jobs=1):
+    """
+    Evaluates each configuration, spreading them across a pool of jobs processes if jobs > 1.
+    :return: a list of results as returned by evaluate, ordered by zone count then error
+    """
+    tasks = [(configuration, folds) for configuration in configurations]
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks)), initializer=_init_worker) as pool:
+            results = pool.map(_evaluate_worker, tasks, chunksize=max(1, len(tasks) // (4 * jobs)))
+    else:
+        samples = load_samples()
+        results = [evaluate(configuration, folds, samples) for configuration, folds in tasks]
+    return sorted(results, key=lambda r: (r['zones'], r['rmse_m']))
+
+
+def pareto_front(results):
+    """ the results with a lower error than every result with as few or fewer zones. """
+    front = []
+    best = float('inf')
+    for result in results:
+        if result['rmse_m'] < best:
+            front.append(result)
+            best = result['rmse_m']
+    return front
+
+
+def report(results, front):
+    print('{0:<8} {1:>6} {2:>8} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+        'layout', 'zones', 'fallback', 'rmse m', 'median m', 'max m', 'fit rmse m'))
+    for result in results:
+        print('{0:<8} {1:>6} {2:>8} {3:>10.2f} {4:>10.2f} {5:>10.2f} {6:>10.2f} {7}'.format(
+            result['layout'], result['zones'], result['fallback_points'], result['rmse_m'], result['median_m'],
+            result['max_m'], result['fit_rmse_m'], '*' if result in front else ''))
+    print('fallback: control points predicted by the degenerate matrix of a zone with too few points to fit')
+    print('* no configuration with as few zones has a lower error')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-max-horizontal", type=int, default=6,
+                        help="evaluate grids of 1 to this many horizontal zones")
+    parser.add_argument("-max-vertical", type=int, default=6,
+                        help="evaluate grids of 1 to this many vertical zones")
+    parser.add_argument("-adaptive", type=int, nargs='*', default=[3, 4, 6, 8, 12, 16],
+                        help="also evaluate k-d tree partitions with these minimum numbers of control points per zone")
+    parser.add_argument("-folds", type=int,
+                        help="cross-validate with this many folds instead of leaving one control point out at a time")
+    parser.add_argument("-jobs", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="the number of configurations to evaluate in parallel")
+    parser.add_argument("-output",
+                        help="also write the results to this file as json")
+    args = parser.parse_args()
+
+    assert all(m >= 3 for m in args.adaptive), "-adaptive zones need at least 3 control points each."
+    assert args.folds is None or args.folds >= 2, "-folds must be at least 2."
+
+    start = time.perf_counter()
+    results = search(configurations(args.max_horizontal, args.max_vertical, args.adaptive), args.folds, args.jobs)
+    front = pareto_front(results)
+
+    report(results, front)
+    print('evaluated {0} configurations with {1} in {2:.2f}s using {3} jobs'.format(
+        len(results), '{0}-fold cross-validation'.format(args.folds) if args.folds else 'leave-one-out',
+        time.perf_counter() - start, args.jobs))
+    best = min(results, key=lambda r: r['rmse_m'])
+    print('lowest error: {0}, {1:.2f} m rmse'.format(best['layout'], best['rmse_m']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'folds': args.folds, 'results': results, 'pareto_front': [r['layout'] for r in front]},
+                      f, indent=2)
+        print('Writing', args.output)
+
+
+if __name__ == '__main__':
+    main()